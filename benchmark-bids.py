@@ -0,0 +1,75 @@
+"""Compare pybids' BIDSLayout against utils.find_files on a synthetic dataset.
+
+Builds a fake BIDS tree (empty data files) with the same file naming as
+this dataset, then times indexing plus a per-participant query with both.
+"""
+import argparse
+import tempfile
+import time
+from pathlib import Path
+
+from bids import BIDSLayout
+import pandas as pd
+
+import utils
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument("-n", "--n-subjects", type=int, default=500)
+args = parser.parse_args()
+
+n_subjects = args.n_subjects
+
+
+def make_tree(root, n_subjects):
+    """Write an empty-file BIDS tree, raw + derivatives, for ``n_subjects``."""
+    description = {"Name": "synthetic", "BIDSVersion": "1.8.0"}
+    utils.export_json(description, root / "dataset_description.json")
+    (root / "derivatives").mkdir()
+    derivatives_description = description | {"GeneratedBy": [{"Name": "synthetic"}]}
+    utils.export_json(derivatives_description, root / "derivatives" / "dataset_description.json")
+    for i in range(1, n_subjects + 1):
+        participant_id = f"sub-{i:03d}"
+        eeg_dir = root / participant_id / "eeg"
+        beh_dir = root / participant_id / "beh"
+        derivatives_dir = root / "derivatives" / participant_id
+        for directory in [eeg_dir, beh_dir, derivatives_dir]:
+            directory.mkdir(parents=True)
+        for task, acq in [("sleep", "nap"), ("sleep", "overnight"), ("bct", "pre"), ("bct", "post")]:
+            stem = f"{participant_id}_task-{task}_acq-{acq}"
+            for suffix in ["eeg.edf", "eeg.json", "events.tsv", "events.json", "channels.tsv", "channels.json"]:
+                eeg_dir.joinpath(f"{stem}_{suffix}").touch()
+            if task == "bct":
+                beh_dir.joinpath(f"{stem}_beh.tsv").touch()
+            else:
+                for suffix in ["hypno.tsv", "cues.tsv", "resp.tsv"]:
+                    derivatives_dir.joinpath(f"{stem}_{suffix}").touch()
+        # pybids parses every json sidecar.
+        for json_path in eeg_dir.glob("*.json"):
+            json_path.write_text("{}")
+
+def time_it(func):
+    start = time.perf_counter()
+    result = func()
+    return time.perf_counter() - start, result
+
+
+results = []
+with tempfile.TemporaryDirectory() as tmp_dir:
+    root = Path(tmp_dir)
+    make_tree(root, n_subjects)
+    query = dict(subject="001", task="sleep", acquisition="nap", extension=".tsv")
+
+    index_time, layout = time_it(lambda: BIDSLayout(root, derivatives=True, validate=False))
+    query_time, pybids_files = time_it(lambda: layout.get(**query))
+    results.append({"method": "BIDSLayout", "index_s": index_time, "query_s": query_time, "n_files": len(pybids_files)})
+
+    query_time, resolver_files = time_it(lambda: utils.find_files(derivatives=True, root=root, **query))
+    results.append({"method": "find_files", "index_s": 0, "query_s": query_time, "n_files": len(resolver_files)})
+
+    assert sorted(bf.path for bf in pybids_files) == [bf.path for bf in resolver_files], "Resolvers disagree"
+
+results = pd.DataFrame(results).set_index("method")
+results["total_s"] = results["index_s"] + results["query_s"]
+print(f"{n_subjects} subjects")
+print(results.round(4).to_string())
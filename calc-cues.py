@@ -4,57 +4,122 @@ Also get length and volume, later when SMACC info is merged again.
 """
 import argparse
 
-from bids import BIDSLayout
 import numpy as np
 import pandas as pd
-import yasa
 
+import hypnogram
 import utils
 
 
-parser = argparse.ArgumentParser()
-parser.add_argument("-p", "--participant", type=int, required=True)
-args = parser.parse_args()
-
-participant = args.participant
-
-
-layout = BIDSLayout(utils.ROOT_DIR, derivatives=True, validate=False)
-bids_files = layout.get(subject=f"{participant:03d}",
-    task="sleep",
-    acquisition="nap",
-    # suffix="hypno",
-    extension=".tsv",
-    # return_type="filename",
-)
-
-for bf in bids_files:
-    if bf.entities["suffix"] == "hypno":
-        hypno = bf.get_df()
-    elif bf.entities["suffix"] == "events" and bf.dirname.endswith("eeg"):  # temp bc old files outside eeg/
-        events = bf.get_df()
-
-events = events.query("description.eq('Cue')")
-
-bins = [(x, x+y) for x, y in zip(hypno["onset"], hypno["duration"])]
-duration = hypno["duration"].unique()[0]
-bins = hypno["onset"].to_numpy()
-bins = np.append(bins, bins[-1]+duration)
-cue_onsets = events["onset"].to_numpy()
-
-# Approach #1
-labels = hypno.index.tolist()
-cut = pd.cut(cue_onsets, bins=bins, labels=labels)
-cued_epochs = cut.to_list()
-hypno["cued"] = False
-hypno.loc[cued_epochs, "cued"] = True
-freqs = hypno.groupby("description")["cued"].sum().rename("frequency").rename_axis("stage")
-
-# # Approach #2
-# labels = hypno["description"].tolist()
-# cut = pd.cut(cue_onsets, bins=bins, labels=labels, ordered=False)
-# freqs = cut.value_counts()
-
-export_pattern = "derivatives/sub-{subject}/sub-{subject}_task-{task}_acq-{acquisition}_cues.tsv"
-export_path = layout.build_path(bf.entities, export_pattern, validate=False)
-utils.export_tsv(freqs, export_path, index=True)
+# Columns identifying a recording in the stacked tables.
+keys = ["participant_id", "acquisition_id"]
+
+
+def load_recordings(participant=None):
+    """Stack the hypnograms and cue events (merged SMACC info) of one or all participants."""
+    subject = None if participant is None else f"{participant:03d}"
+    hypno = utils.load_group(
+        entities=["subject", "acquisition"],
+        derivatives=True,
+        subject=subject,
+        task="sleep",
+        suffix="hypno",
+    )
+    events = utils.load_group(
+        entities=["subject", "acquisition"],
+        subject=subject,
+        task="sleep",
+        suffix="events",
+        datatype="eeg",
+    )
+    cues = events.query("description.eq('Cue')")
+    return hypno, cues
+
+def stage_counts(hypno, cues):
+    """Per recording and stage: cue counts, cue density and cue volume.
+
+    One overlap pass (``hypnogram.stage_overlap``) covers every recording.
+    ``frequency`` counts the epochs with at least one cue onset (as the
+    earlier per-epoch version did), ``n_cues`` the cues whose onset falls
+    in the stage and ``seconds`` the cue time spent in the stage, from
+    each cue's ``duration``. ``minutes`` is the time spent in the stage,
+    ``density`` the cues started per minute of it, and ``volume_*``
+    summarize the volume of the cues started in it.
+    """
+    n_stages = len(utils.SLEEP_STAGES)
+    recordings = hypno.groupby(keys, observed=True).size().index
+    n_bins = len(recordings) * n_stages
+    recording_ids = pd.Series(np.arange(len(recordings)), index=recordings, name="recording")
+    hypno_recording = hypno[keys].join(recording_ids, on=keys)["recording"].to_numpy()
+    cue_recording = cues[keys].join(recording_ids, on=keys)["recording"]
+
+    seconds, onset_epoch = hypnogram.stage_overlap(hypno, cues, keys)
+    stage = hypno["value"].to_numpy().astype(np.intp)
+    # Flat (recording, stage) bin of each epoch.
+    epoch_bins = hypno_recording * n_stages + stage
+
+    cued = onset_epoch >= 0
+    n_cues = np.bincount(epoch_bins[onset_epoch[cued]], minlength=n_bins)
+    frequency = np.bincount(epoch_bins[np.unique(onset_epoch[cued])], minlength=n_bins)
+    minutes = np.bincount(epoch_bins, weights=hypno["duration"].to_numpy(), minlength=n_bins) / 60
+    known = cue_recording.notna().to_numpy()
+    seconds_sum = np.zeros((len(recordings), n_stages))
+    np.add.at(seconds_sum, cue_recording[known].to_numpy(dtype=np.intp), seconds.to_numpy()[known])
+    volume = (cues.loc[cued, "volume"]
+        .groupby(epoch_bins[onset_epoch[cued]])
+        .agg(["mean", "min", "max"])
+        .add_prefix("volume_")
+        .reindex(np.arange(n_bins))
+    )
+
+    index = pd.MultiIndex.from_tuples(
+        [(*recording, stage) for recording in recordings for stage in utils.SLEEP_STAGES],
+        names=keys + ["stage"],
+    )
+    return pd.DataFrame(
+        {
+            "frequency": frequency,
+            "n_cues": n_cues,
+            "seconds": seconds_sum.ravel(),
+            "minutes": minutes,
+            "density": np.divide(n_cues, minutes, out=np.full(n_bins, np.nan), where=minutes > 0),
+            **{column: volume[column].to_numpy() for column in volume},
+        },
+        index=index,
+    )
+
+def export_counts(counts):
+    """Write one ``_cues.tsv`` per recording."""
+    export_pattern = "derivatives/{participant_id}/{participant_id}_task-sleep_{acquisition_id}_cues.tsv"
+    for (participant_id, acquisition_id), df in counts.groupby(level=keys, observed=True):
+        entities = {"participant_id": participant_id, "acquisition_id": acquisition_id}
+        export_path = utils.build_path(entities, export_pattern)
+        utils.export_tsv(df.droplevel(keys), export_path, index=True)
+
+def run(participant):
+    """Count the cues played in each sleep stage of one participant's recordings."""
+    hypno, cues = load_recordings(participant)
+    export_counts(stage_counts(hypno, cues))
+
+def run_all():
+    """Count cues per stage for every participant in one pass.
+
+    Writes the per-recording files and a group table with all of them.
+    """
+    hypno, cues = load_recordings()
+    counts = stage_counts(hypno, cues)
+    export_counts(counts)
+    export_path = utils.DERIVATIVES_DIR / "task-sleep_cues.tsv"
+    utils.export_tsv(counts.reset_index(), export_path, index=False)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument("-p", "--participant", type=int)
+    group.add_argument("--all", action="store_true", help="all participants in one pass, plus a group table")
+    args = parser.parse_args()
+
+    if args.all:
+        run_all()
+    else:
+        run(args.participant)
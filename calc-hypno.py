@@ -1,137 +1,207 @@
 """Export hypnogram tsv events files for a single subject. Some have 2 some have 1."""
 
 import argparse
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+import sys
+import traceback
 
-from bids import BIDSLayout
 import mne
 import pandas as pd
 import tqdm
 import yasa
 
+import hypnogram
+import staging
 import utils
 
 mne.set_log_level(verbose=utils.MNE_VERBOSITY)
 
-parser = argparse.ArgumentParser()
-parser.add_argument("-p", "--participant", type=int, required=True)
-args = parser.parse_args()
-
-
-participant = args.participant
-
-
-import_path = utils.ROOT_DIR / "phenotype" / "initial_survey.tsv"
-demogr = pd.read_csv(import_path, sep="\t")
-
-if participant in demogr.index:
-    age = demogr.loc[participant, "Age"]
-    if age == 1:
-        metadata = {"age": 20}
-    elif age == 2:
-        metadata = {"age": 30}
-    elif age == 3:
-        metadata = {"age": 40}
-    elif age == 4:
-        metadata = {"age": 50}
-    elif age == 5:
-        metadata = {"age": 60}
-    elif age == 6:
-        metadata = {"age": 70}
-
-    gender = demogr.loc[participant, "Sex"]
-    if gender in [1, 2]:
-        metadata["male"] = True if gender == 1 else False
-else:
-    metadata = None
 
 eeg_channel = "Fz"
 eog_channel = "R-HEOG"
 emg_channel = "EMG"
-epoch_length = 30
-
-layout = BIDSLayout(utils.ROOT_DIR, validate=False)
-# stimuli_dir = bids_root / "stimuli"
-bids_files = layout.get(
-    subject=f"{participant:03d}",
-    task="sleep",
-    suffix="eeg",
-    # extension=utils.EEG_RAW_EXTENSION,
-    extension=".edf",
-)
-
-# Loop over each file and export a hypnogram events file.
-for bf in tqdm.tqdm(bids_files, desc="Sleep Staging"):
-
-    # Load raw data.
-    # raw = mne.io.read_raw_fif(bf.path)
-    raw = mne.io.read_raw_edf(bf.path)
-
-    # Drop to the only channels needed for staging.
-    raw.pick([eeg_channel, eog_channel, emg_channel])
-
-    #### YASA ARTIFACT DETECTION
-
-    # Load data.
-    raw.load_data()
-
-    # Perform YASA's automatic sleep staging.
-    sls = yasa.SleepStaging(raw,
-        eeg_name=eeg_channel,
-        eog_name=eog_channel,
-        emg_name=emg_channel,
-        metadata=metadata,
+
+
+def load_metadata(participant):
+    """Demographics passed to YASA (None if the participant has none)."""
+    import_path = utils.ROOT_DIR / "phenotype" / "initial_survey.tsv"
+    demogr = pd.read_csv(import_path, sep="\t")
+
+    if participant in demogr.index:
+        age = demogr.loc[participant, "Age"]
+        if age == 1:
+            metadata = {"age": 20}
+        elif age == 2:
+            metadata = {"age": 30}
+        elif age == 3:
+            metadata = {"age": 40}
+        elif age == 4:
+            metadata = {"age": 50}
+        elif age == 5:
+            metadata = {"age": 60}
+        elif age == 6:
+            metadata = {"age": 70}
+
+        gender = demogr.loc[participant, "Sex"]
+        if gender in [1, 2]:
+            metadata["male"] = True if gender == 1 else False
+    else:
+        metadata = None
+    return metadata
+
+def hypno_frame(hypno_str, hypno_proba):
+    """Hypnogram events rows for staged epochs (``hypno_proba`` is indexed by epoch)."""
+    return hypnogram.to_events(hypno_str, hypno_proba,
+        first_epoch=hypno_proba.index[0],
+        scorer=f"YASA-v{yasa.__version__}",
+        eeg_channel=eeg_channel,
+        eog_channel=eog_channel,
+        emg_channel=emg_channel,
     )
 
-    hypno_str = sls.predict()
-    hypno_proba = sls.predict_proba()
-    hypno_proba = hypno_proba.add_prefix("proba_")
-    # hypno_proba.columns = hypno_proba.columns.map("proba_{}".format)
-
-    # Generate events dataframe for hypnogram.
-    n_epochs = len(hypno_str)
-    hypno_int = yasa.hypno_str_to_int(hypno_str)
-    hypno_events = {
-        "onset": [epoch_length*i for i in range(n_epochs)],
-        "duration": [epoch_length for i in range(n_epochs)],
-        "value" : hypno_int,
-        "description" : hypno_str,
-        "scorer": f"YASA-v{yasa.__version__}",
-        "eeg_channel": eeg_channel,
-        "eog_channel": eog_channel,
-        "emg_channel": emg_channel,
-    }
-    hypno = pd.DataFrame.from_dict(hypno_events).join(hypno_proba.reset_index())
-
-    hypno_sidecar = {
-        "onset": {
-            "LongName": "Onset (in seconds) of the event",
-            "Description": "Onset (in seconds) of the event"
-        },
-        "duration": {
-            "LongName": "Duration of the event (measured from onset) in seconds",
-            "Description": "Duration of the event (measured from onset) in seconds"
-        },
-        "value": {
-            "LongName": "Marker/trigger value associated with the event",
-            "Description": "Marker/trigger value associated with the event"
-        },
-        "description": {
-            "LongName": "Value description",
-            "Description": "Readable explanation of value markers column"
-        },
-        "scorer": {},
-        "eeg_channel": {},
-        "eog_channel": {},
-        "emg_channel": {}
-    }
-    for x in ["N1", "N2", "N3", "R", "W"]:
-        hypno_sidecar[f"proba_{x}"] = {
-            "LongName": f"Probability of {x}",
-            "Description": f"YASA's estimation of {x} likelihood"
-        }
-
-    # Export.
+def hypno_path(bf):
     export_pattern = "derivatives/sub-{subject}/sub-{subject}_task-{task}_acq-{acquisition}_hypno.tsv"
-    export_path = layout.build_path(bf.entities, export_pattern, validate=False)
+    return utils.build_path(bf.entities, export_pattern)
+
+def export_hypno(bf, hypno_str, hypno_proba):
+    """Write the hypnogram events file (and sidecar) of one recording."""
+    hypno = hypno_frame(hypno_str, hypno_proba)
+    export_path = hypno_path(bf)
     utils.export_tsv(hypno, export_path, index=False)
-    utils.export_json(hypno_sidecar, export_path.replace(".tsv", ".json"))
+    utils.export_json(hypnogram.SIDECAR, export_path.replace(".tsv", ".json"))
+
+def stage_files(bids_files, cache=True):
+    """Stage a set of recordings, with one classifier call per classifier needed.
+
+    Features of every recording are extracted first, then recordings are
+    grouped by the classifier their inputs require (e.g. with or without
+    demographics) and each group is predicted in one batch.
+    Features are cached per recording (see ``staging.cached_features``).
+    """
+    metadata = {}
+    by_model = defaultdict(list)
+    for bf in tqdm.tqdm(bids_files, desc="Staging features"):
+        participant = int(bf.entities["subject"])
+        if participant not in metadata:
+            metadata[participant] = load_metadata(participant)
+
+        # Features come from the staging cache when this recording and channel
+        # triplet were staged before, otherwise only the staging channels are
+        # read (from the memory-mapped sample store when source2raw-eeg.py wrote one).
+        features, model = staging.cached_features(bf.path,
+            eeg_name=eeg_channel,
+            eog_name=eog_channel,
+            emg_name=emg_channel,
+            metadata=metadata[participant],
+            cache=cache,
+        )
+        by_model[model].append((bf, features))
+
+    # Loop over each classifier and export a hypnogram events file per recording.
+    for model, recordings in tqdm.tqdm(by_model.items(), desc="Sleep Staging"):
+        results = staging.predict([features for _, features in recordings], model)
+        for (bf, _), (hypno_str, hypno_proba) in zip(recordings, results):
+            export_hypno(bf, hypno_str, hypno_proba)
+
+def stream_files(bids_files, block_duration=600):
+    """Stage recordings one at a time without loading them in memory.
+
+    While a recording is processed, provisional rows are appended to a
+    ``_hypno.partial.tsv`` next to the final file, which replaces it when
+    the whole night has been staged.
+    """
+    for bf in tqdm.tqdm(bids_files, desc="Sleep Staging"):
+        participant = int(bf.entities["subject"])
+        partial_path = hypno_path(bf).replace(".tsv", ".partial.tsv")
+
+        def append_rows(hypno_str, hypno_proba):
+            hypno = hypno_frame(hypno_str, hypno_proba)
+            first = hypno_proba.index[0] == 0
+            utils.export_tsv(hypno, partial_path, index=False, mode="w" if first else "a", header=first)
+
+        hypno_str, hypno_proba = staging.stream_stage(bf.path,
+            eeg_name=eeg_channel,
+            eog_name=eog_channel,
+            emg_name=emg_channel,
+            metadata=load_metadata(participant),
+            block_duration=block_duration,
+            callback=append_rows,
+        )
+        export_hypno(bf, hypno_str, hypno_proba)
+        Path(partial_path).unlink(missing_ok=True)
+
+def run(participant, cache=True, stream=False):
+    """Stage every sleep recording of one participant and export the hypnograms."""
+    # stimuli_dir = bids_root / "stimuli"
+    bids_files = utils.find_files(
+        subject=f"{participant:03d}",
+        task="sleep",
+        suffix="eeg",
+        # extension=utils.EEG_RAW_EXTENSION,
+        extension=".edf",
+    )
+    if stream:
+        stream_files(bids_files)
+    else:
+        stage_files(bids_files, cache=cache)
+
+def stage_one(bf, cache=True, stream=False):
+    """Stage and export a single recording (process pool worker)."""
+    if stream:
+        stream_files([bf])
+    else:
+        stage_files([bf], cache=cache)
+    return bf.path
+
+def stage_parallel(bids_files, jobs, cache=True, stream=False):
+    """Stage recordings in ``jobs`` worker processes, each writing its own hypnogram.
+
+    Progress is tracked here as recordings finish, and a failing recording
+    doesn't stop the others. Returns ``{path: traceback}`` of the failures.
+    """
+    failures = {}
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(stage_one, bf, cache, stream): bf for bf in bids_files}
+        for future in tqdm.tqdm(as_completed(futures), total=len(futures), desc="Recordings"):
+            try:
+                future.result()
+            except Exception:
+                failures[futures[future].path] = traceback.format_exc()
+    return failures
+
+def run_all(cache=True, stream=False, jobs=1):
+    """Stage every sleep recording in the dataset, in one batch or on ``jobs`` processes.
+
+    Returns the failed recordings (see :func:`stage_parallel`), always
+    empty when staging in one batch since any error stops the batch.
+    """
+    bids_files = utils.find_files(task="sleep", suffix="eeg", extension=".edf")
+    if jobs > 1:
+        return stage_parallel(bids_files, jobs, cache=cache, stream=stream)
+    if stream:
+        stream_files(bids_files)
+    else:
+        stage_files(bids_files, cache=cache)
+    return {}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument("-p", "--participant", type=int)
+    group.add_argument("--all", action="store_true", help="stage all participants' recordings")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="worker processes for --all (one recording each)")
+    parser.add_argument("--no-cache", action="store_true", help="recompute staging features")
+    parser.add_argument("--stream", action="store_true", help="stage epoch blocks without loading whole recordings")
+    args = parser.parse_args()
+
+    if args.all:
+        failures = run_all(cache=not args.no_cache, stream=args.stream, jobs=args.jobs)
+        for path, error in failures.items():
+            print(f"{path}\n{error}", file=sys.stderr)
+        if failures:
+            sys.exit("Failed recordings: " + ", ".join(Path(path).name for path in failures))
+    else:
+        run(args.participant, cache=not args.no_cache, stream=args.stream)
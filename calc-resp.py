@@ -2,180 +2,172 @@
 import argparse
 from pathlib import Path
 
-from bids import BIDSLayout
 import mne
 import neurokit2 as nk
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
 import pandas as pd
 
+import psg
 import utils
 
 mne.set_log_level(verbose=utils.MNE_VERBOSITY)
 
-parser = argparse.ArgumentParser()
-parser.add_argument("-p", "--participant", type=int, required=True)
-args = parser.parse_args()
-
-
-participant = args.participant
-
-resp_channels = ["RESP", "Airflow"]
-
-layout = BIDSLayout(utils.ROOT_DIR, validate=False)
-# stimuli_dir = bids_root / "stimuli"
-bids_files = layout.get(
-    subject=f"{participant:03d}",
-    task="sleep",
-    suffix="eeg",
-    # extension=utils.EEG_RAW_EXTENSION,
-    extension=".edf",
-)
-
-
-def get_epoched_data(raw, events, event_id, resp_channel, tmin, tmax):
-    epochs = mne.Epochs(
-        raw,
-        events,
-        event_id=event_id,
-        tmin=tmin,
-        tmax=tmax,  # because of this i might not even use Epochs (cues played diff lengths)
-        picks=resp_channel,
-        preload=True,
-        on_missing="warn",
-        baseline=(0, 0), ## CHECK ON THIS
-    )
-    data = epochs.get_data().squeeze() # squeeze out extra axis bc just one channel
-    return data
-
-
-def get_rr_features(arr, sfreq):
-    # # Clean signal.
-    # rsp = nk.rsp_clean(arr, sampling_rate=sfreq, method="khodadad2018")
-    # # Extract candidate peaks.
-    # df, peaks_dict = nk.rsp_peaks(rsp) 
-    # # Get fixed peaks.
-    # info = nk.rsp_fixpeaks(peaks_dict)
-    # # Extract respiration rate.
-    # rrate = nk.rsp_rate(rsp, peaks_dict, sampling_rate=sfreq)
-    # # Calculate respiration rate variability (RRV) features.
-    # rrv = nk.rsp_rrv(rrate, info, sampling_rate=sfreq)
-    # Prepreocess respiratory signal and get some values
-    signals, info = nk.rsp_process(arr, sampling_rate=sfreq,
-        method="khodadad2018", method_rvt="harrison2021",
-        report=None,
-    )
-    ######### I'm just using epochs to get the data chunks. prob overkill
-    ## only need it if looking at short ERP-like stuff
-    # a = nk.rsp_analyze(data, sampling_rate=sfreq, method="auto")
-    ######## SHOULD use nk epochs and pass to eventrelated?
-    ######## yes becaue easier to include true duration
-    rr = nk.rsp_intervalrelated(signals, sampling_rate=sfreq)
-    # b = nk.rsp_eventrelated(signals, sampling_rate=sfreq)
-    return rr
-
-for bf in bids_files:
-
-    # Load raw data.
-    raw = mne.io.read_raw_edf(bf.path)
-
-    # Extract sampling frequency (for convenience).
-    sfreq = raw.info["sfreq"]
-
-    ### Don't need EVENTS anymore
-    # Add annotations from events file.
-    events_path = bf.path.replace("eeg.edf", "events.tsv")
-    if not Path(events_path).exists():
-        continue
-    events = pd.read_csv(events_path, sep="\t")
-    # events = mne.read_events(bf.path.replace("eeg.edf", "events.tsv"))
-    # mne.pick_events()
-    if "Cue" not in events["description"].values:
-        continue
-
-    events = events.query("description=='Cue'").reset_index(drop=True)
-
-    # load respiratory signal
-    raw.pick_channels(resp_channels)
-    raw.load_data()
 
+# Seconds of respiration before each cue, and minimum after it.
+cue_window = 60
+
+
+def cue_windows(events, sfreq, window=cue_window):
+    """Start sample and length of the pre- and post-cue windows of each cue.
+
+    Pre-cue windows are the ``window`` seconds before the cue onset.
+    Post-cue windows start at onset and last the cue's duration, or
+    ``window`` seconds if the cue is shorter.
+    """
+    onset = np.round(events["onset"].to_numpy() * sfreq).astype(int)
+    pre_length = np.full(onset.size, int(round(window * sfreq)))
+    post_length = np.round(np.maximum(events["duration"].fillna(0).to_numpy(), window) * sfreq).astype(int)
+    return {"pre": (onset - pre_length, pre_length), "post": (onset, post_length)}
+
+def window_views(arr, starts, length):
+    """Rows of ``arr`` starting at each of ``starts``, ``(n_windows, length)``.
+
+    Windows are taken from a strided view of the (NaN-padded) signal, so
+    windows running off either end of the recording get NaNs there.
+    """
+    pad = np.full(length, np.nan)
+    padded = np.concatenate([pad, arr, pad])
+    return sliding_window_view(padded, length)[starts + length]
+
+def masked_mean(views, mask):
+    """Row means over the masked, non-NaN samples (NaN for empty rows)."""
+    valid = mask & ~np.isnan(views)
+    total = np.where(valid, views, 0).sum(axis=1)
+    count = valid.sum(axis=1)
+    return np.divide(total, count, out=np.full(total.shape, np.nan), where=count > 0)
+
+def rrv_features(peaks, mask, sfreq):
+    """Time-domain respiration rate variability of each window (as ``nk.rsp_rrv``).
+
+    ``peaks`` is the windowed peak indicator. Breath-to-breath intervals
+    (ms) of all windows are computed at once and summarized per window.
+    """
+    rows, cols = np.nonzero((peaks == 1) & mask)
+    same = np.diff(rows) == 0
+    bbi = pd.Series(np.diff(cols)[same] / sfreq * 1000, index=rows[1:][same])
+    grouped = bbi.groupby(level=0)
+    diff = grouped.diff().dropna()
+    mean = grouped.mean()
+    median = grouped.median()
+    rrv = pd.DataFrame({
+        "RRV_RMSSD": np.sqrt((diff ** 2).groupby(level=0).mean()),
+        "RRV_MeanBB": mean,
+        "RRV_SDBB": grouped.std(),
+        "RRV_SDSD": diff.groupby(level=0).std(),
+        "RRV_MedianBB": median,
+        "RRV_MadBB": (bbi - median.reindex(bbi.index).to_numpy()).abs().groupby(level=0).median() * 1.4826,
+    })
+    rrv["RRV_CVBB"] = rrv["RRV_SDBB"] / rrv["RRV_MeanBB"]
+    rrv["RRV_CVSD"] = rrv["RRV_RMSSD"] / rrv["RRV_MeanBB"]
+    rrv["RRV_MCVBB"] = rrv["RRV_MadBB"] / rrv["RRV_MedianBB"]
+    return rrv.reindex(np.arange(len(peaks)))
+
+def cue_features(signals, events, sfreq, window=cue_window):
+    """Respiration rate, amplitude and RRV in the pre- and post-cue windows of every cue.
+
+    ``signals`` is the output of ``nk.rsp_process`` for the whole recording,
+    ``events`` the cue events (one row per cue). Each feature is computed
+    for all cues of a window location in one batch over strided windows,
+    instead of epoching and analyzing cue by cue.
+    """
     dataframes = []
-    for ch in resp_channels:
-        data = raw.get_data(picks=ch).squeeze()
-        signals, info = nk.rsp_process(data,
-            sampling_rate=sfreq,
-            method="khodadad2018",
-            method_rvt="harrison2021",
-            report=None,
-        )
-        signals.insert(0, "time", raw.times)
-        signals.insert(0, "channel", ch)
-        dataframes.append(signals)
-
-    df = pd.concat(dataframes, ignore_index=True)
-
-    export_pattern = "derivatives/sub-{subject}/sub-{subject}_task-{task}_acq-{acquisition}_resp.tsv"
-    export_path = layout.build_path(bf.entities, export_pattern, validate=False)
-    utils.export_tsv(df, export_path, index=False)
-
-    # # Epochs
-    # epochs = nk.epochs_create(
-    #     signals["RSP_Clean"],
-    #     events=events["onset"].to_list(),
-    #     sampling_rate=sfreq,
-    #     epochs_start=0,
-    #     epochs_end=events["duration"].to_list(),
-    #     event_labels=None,
-    #     event_conditions=events["stim_file"].to_list(),
-    #     baseline_correction=False,
-    # )
-    # epochs_df = nk.epochs_to_df(epochs)
-
-    # # Convert to epochs.
-    # events_arr = events[["onset", "duration", "value"]].to_numpy()
-    # # events don't have durations :/
-    # events_arr[:, 1] = 0
-    # # convert seconds to samples
-    # # TODO: should events files be exported with samples??
-    # events_arr[:, 0] = (events_arr[:, 0] * sfreq - 1).round()
-    # events_arr = events_arr.astype(int)
-    # events_desc = events.set_index("value")["description"].to_dict()
-
-    # # weird they have to be strings
-    # events_desc = {str(k): v for k, v in events_desc.items()}
-    # epochs = mne.Epochs(raw, events_arr, tmin=-0.2, tmax=0.5, event_id=events_desc)
-
-    # # Create equally spaced events
-    # mne.events_from_annotations(raw, chunk_duration=1.5)
-    # mne.make_fixed_length_events()
-
-    # ###############
-    # ######### FUCKING MNE ANNOTATIONS ONSET IS IN SECONDS AND EVENTS ONSET IS IN SAMPLES
-    # ###########
-    # # Go annotations to events FOR NOW bc exported "events" have onset in duration.
-    # # That way it converts samples to seconds and weird code shit for us.
-    # # Confused y this does not return annotations with duration??
-    # # events_arr = events[["onset", "duration", "value"]].to_numpy()
-    # # events_desc = events.set_index("value")["description"].to_dict()
-    # # annotations = mne.annotations_from_events(events_arr, sfreq, event_desc=events_desc, first_samp=0, orig_time=None)
-    # # So creating manually.
-    # annotations = mne.Annotations(
-    #     onset=events["onset"].to_numpy(),
-    #     duration=events["duration"].to_numpy(),
-    #     description=events["description"].to_numpy(),
-    # )
-    # raw.set_annotations(annotations)
-    # events, event_id = mne.events_from_annotations(raw)
-
-    # events = mne.pick_events(events, include=event_id["Cue"])
-
-
-    # # rrv_list = np.apply_along_axis(get_rrv, axis=1, arr=data)
-    # pre = pd.concat([get_rr_features(row, sfreq) for row in get_epoched_data(raw, events, event_id, resp_channel, tmin=-60, tmax=0)], ignore_index=True).rename_axis("cue").assign(location="pre").set_index("location", append=True)
-    # post = pd.concat([get_rr_features(row, sfreq) for row in get_epoched_data(raw, events, event_id, resp_channel, tmin=0, tmax=60)], ignore_index=True).rename_axis("cue").assign(location="post").set_index("location", append=True)
-
-    # df = pd.concat([pre, post]).sort_index(ascending=[True, False])
-
-
-    # export_pattern = "derivatives/sub-{subject}/sub-{subject}_task-{task}_acq-{acquisition}_resp.tsv"
-    # export_path = layout.build_path(bf.entities, export_pattern, validate=False)
-    # utils.export_tsv(df, export_path, index=True)
+    for location, (starts, lengths) in cue_windows(events, sfreq, window).items():
+        length = lengths.max()
+        mask = np.arange(length) < lengths[:, None]
+        features = {}
+        for column in ["RSP_Rate", "RSP_Amplitude"]:
+            features[f"{column}_Mean"] = masked_mean(window_views(signals[column].to_numpy(), starts, length), mask)
+        if "RSP_Symmetry_PeakTrough" in signals:
+            views = window_views(signals["RSP_Symmetry_PeakTrough"].to_numpy(), starts, length)
+            features["RSP_Symmetry_PeakTrough"] = masked_mean(views, mask)
+        peaks = window_views(signals["RSP_Peaks"].to_numpy(dtype=float), starts, length)
+        df = pd.DataFrame(features).join(rrv_features(peaks, mask, sfreq))
+        df.insert(0, "location", location)
+        df.insert(0, "cue", np.arange(len(df)))
+        dataframes.append(df)
+    return (pd.concat(dataframes, ignore_index=True)
+        .sort_values("cue", kind="stable")
+        .reset_index(drop=True)
+    )
+
+
+def run(participant):
+    """Export continuous and cue-locked respiration features for each cued sleep recording."""
+    resp_channels = ["RESP", "Airflow"]
+
+    # stimuli_dir = bids_root / "stimuli"
+    bids_files = utils.find_files(
+        subject=f"{participant:03d}",
+        task="sleep",
+        suffix="eeg",
+        # extension=utils.EEG_RAW_EXTENSION,
+        extension=".edf",
+    )
+    for bf in bids_files:
+
+        ### Don't need EVENTS anymore
+        # Add annotations from events file.
+        events_path = bf.path.replace("eeg.edf", "events.tsv")
+        if not Path(events_path).exists():
+            continue
+        events = utils.read_tsv(events_path)
+        # events = mne.read_events(bf.path.replace("eeg.edf", "events.tsv"))
+        # mne.pick_events()
+        if "Cue" not in events["description"].values:
+            continue
+
+        events = events.query("description=='Cue'").reset_index(drop=True)
+
+        # load respiratory signal (from the memory-mapped store if there is one)
+        raw = psg.read_raw(bf.path, picks=resp_channels)
+
+        # Extract sampling frequency (for convenience).
+        sfreq = raw.info["sfreq"]
+
+        dataframes = []
+        cue_dataframes = []
+        for ch in resp_channels:
+            data = raw.get_data(picks=ch).squeeze()
+            signals, info = nk.rsp_process(data,
+                sampling_rate=sfreq,
+                method="khodadad2018",
+                method_rvt="harrison2021",
+                report=None,
+            )
+            features = cue_features(signals, events, sfreq)
+            features.insert(0, "channel", ch)
+            cue_dataframes.append(features)
+            signals.insert(0, "time", raw.times)
+            signals.insert(0, "channel", ch)
+            dataframes.append(signals)
+
+        df = pd.concat(dataframes, ignore_index=True)
+
+        export_pattern = "derivatives/sub-{subject}/sub-{subject}_task-{task}_acq-{acquisition}_resp.tsv"
+        export_path = utils.build_path(bf.entities, export_pattern)
+        utils.export_tsv(df, export_path, index=False)
+
+        # Pre/post-cue features, one row per channel, cue and window location.
+        df = pd.concat(cue_dataframes, ignore_index=True)
+        export_pattern = "derivatives/sub-{subject}/sub-{subject}_task-{task}_acq-{acquisition}_rrv.tsv"
+        export_path = utils.build_path(bf.entities, export_pattern)
+        utils.export_tsv(df, export_path, index=False)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-p", "--participant", type=int, required=True)
+    args = parser.parse_args()
+
+    run(args.participant)
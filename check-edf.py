@@ -0,0 +1,73 @@
+"""Check psg.write_edf against mne.export.export_raw on a synthetic recording.
+
+Writes a short random recording (with annotations spread over the night and
+a partial last data record) with both writers, then compares the files byte
+for byte and the samples read back from each. source2raw-eeg.py keeps
+exporting with MNE unless ``--fast-edf`` is given, this is what has to pass
+before that flag becomes the default.
+"""
+import argparse
+import sys
+import tempfile
+from pathlib import Path
+
+import mne
+import numpy as np
+
+import psg
+import utils
+
+mne.set_log_level(verbose=utils.MNE_VERBOSITY)
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument("-d", "--duration", type=float, default=65.5, help="recording duration (seconds)")
+parser.add_argument("-s", "--sfreq", type=float, default=256)
+parser.add_argument("--seed", type=int, default=0)
+args = parser.parse_args()
+
+
+def make_raw(duration, sfreq, seed):
+    """Random EEG/EOG/EMG/respiration recording with a few annotations."""
+    rng = np.random.default_rng(seed)
+    ch_names = ["Fz", "C3", "R-HEOG", "EMG", "RESP"]
+    ch_types = ["eeg", "eeg", "eog", "emg", "misc"]
+    info = mne.create_info(ch_names, sfreq, ch_types)
+    n_times = int(duration * sfreq)
+    data = rng.normal(scale=50e-6, size=(len(ch_names), n_times))
+    # Respiration isn't in Volts, it's written unscaled and without unit.
+    data[4] = rng.normal(scale=0.5, size=n_times)
+    # Extreme samples that must survive the header rounding.
+    data[0, 10] = 1234.56789e-6
+    data[2, 20] = -987.654321e-6
+    raw = mne.io.RawArray(data, info)
+    raw.info["line_freq"] = 60
+    raw.set_meas_date(1700000000.25)
+    # Onsets with more decimals than a header field holds, one per data record or so.
+    onsets = np.linspace(0, duration - 1, 6) + 0.123456789
+    raw.set_annotations(mne.Annotations(onsets, 0.5, [f"Cue{i}" for i in range(onsets.size)],
+        orig_time=raw.info["meas_date"]))
+    return raw
+
+
+raw = make_raw(args.duration, args.sfreq, args.seed)
+with tempfile.TemporaryDirectory() as tmp_dir:
+    fast_path = Path(tmp_dir) / "fast_eeg.edf"
+    mne_path = Path(tmp_dir) / "mne_eeg.edf"
+    psg.write_edf(raw, fast_path)
+    mne.export.export_raw(mne_path, raw, add_ch_type=False, overwrite=True)
+    mismatch = psg.compare_edf(raw, fast_path)
+
+    fast = mne.io.read_raw_edf(fast_path, preload=True)
+    reference = mne.io.read_raw_edf(mne_path, preload=True)
+    sample_error = np.abs(fast.get_data() - reference.get_data()).max()
+    resp_std = fast.get_data(picks="RESP").std(), reference.get_data(picks="RESP").std()
+    fast_annotations = sorted(zip(fast.annotations.onset, fast.annotations.description))
+    reference_annotations = sorted(zip(reference.annotations.onset, reference.annotations.description))
+
+print(f"First differing byte: {mismatch}")
+print(f"Max sample difference: {sample_error:.3g}")
+print(f"RESP std (write_edf, MNE): {resp_std[0]:.3g}, {resp_std[1]:.3g}")
+print(f"Annotations match: {fast_annotations == reference_annotations}")
+if mismatch is not None or sample_error > 0 or fast_annotations != reference_annotations:
+    sys.exit("write_edf does not match mne.export.export_raw")
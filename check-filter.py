@@ -0,0 +1,56 @@
+"""Check psg.FilterBank against one raw.filter call per band on a synthetic recording.
+
+The filter bank is what source2raw-eeg.py applies by default, so it has
+to give the same numbers as MNE over the whole recording, including the
+edges where the padding mode matters (up to about half the longest kernel,
+~33 s for the 0.1 Hz respiration band).
+"""
+import argparse
+import sys
+
+import mne
+import numpy as np
+
+import psg
+import utils
+
+mne.set_log_level(verbose=utils.MNE_VERBOSITY)
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument("-d", "--duration", type=float, default=300, help="recording duration (seconds)")
+parser.add_argument("-s", "--sfreq", type=float, default=500)
+parser.add_argument("--seed", type=int, default=0)
+args = parser.parse_args()
+
+
+def make_raw(duration, sfreq, seed):
+    """Random recording with a channel for every filter band, and a DC offset."""
+    rng = np.random.default_rng(seed)
+    ch_names = ["Fz", "C3", "R-HEOG", "EMG", "Snoring", "RESP", "Airflow"]
+    ch_types = ["eeg", "eeg", "eog", "emg", "misc", "misc", "misc"]
+    info = mne.create_info(ch_names, sfreq, ch_types)
+    n_times = int(duration * sfreq)
+    data = rng.normal(scale=50e-6, size=(len(ch_names), n_times)).cumsum(axis=-1) / 100
+    data += rng.normal(scale=100e-6, size=(len(ch_names), 1))
+    return mne.io.RawArray(data, info)
+
+
+raw = make_raw(args.duration, args.sfreq, args.seed)
+bank_raw = psg.FilterBank().apply_raw(raw.copy())
+mne_raw = raw.copy()
+for band, (l_freq, h_freq) in utils.FILTER_CUTOFFS.items():
+    mne_raw.filter(l_freq, h_freq, picks=utils.FILTER_PICKS[band], **utils.FILTER_PARAMS)
+
+bank = bank_raw.get_data()
+reference = mne_raw.get_data()
+# Error relative to each channel's filtered amplitude, near the edges and in the middle.
+error = np.abs(bank - reference) / reference.std(axis=-1, keepdims=True)
+edge = int(60 * args.sfreq)
+edge_error = max(error[:, :edge].max(), error[:, -edge:].max())
+middle_error = error[:, edge:-edge].max()
+
+print(f"Max relative error, first/last 60 s: {edge_error:.3g}")
+print(f"Max relative error, middle: {middle_error:.3g}")
+if max(edge_error, middle_error) > 1e-8:
+    sys.exit("FilterBank does not match raw.filter")
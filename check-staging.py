@@ -0,0 +1,63 @@
+"""Check staging.finish_features against yasa.SleepStaging.get_features.
+
+Builds a synthetic 100-Hz recording (so SleepStaging doesn't resample),
+computes the per-epoch base features the way the streaming path does on
+the same YASA-filtered epochs, finishes them with the whole night as
+calc-hypno.py's final restaging does, and compares every column with
+the features SleepStaging gives the classifier.
+"""
+import argparse
+import sys
+
+import mne
+import numpy as np
+import pandas as pd
+import yasa
+
+import staging
+import utils
+
+mne.set_log_level(verbose=utils.MNE_VERBOSITY)
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument("-d", "--duration", type=float, default=3600, help="recording duration (seconds)")
+parser.add_argument("--seed", type=int, default=0)
+args = parser.parse_args()
+
+channels = {"eeg": "Fz", "eog": "R-HEOG", "emg": "EMG"}
+metadata = {"age": 30, "male": True}
+
+
+def make_raw(duration, seed):
+    """Random EEG/EOG/EMG recording whose amplitude drifts over the night."""
+    rng = np.random.default_rng(seed)
+    info = mne.create_info(list(channels.values()), staging.STAGING_SFREQ, list(channels))
+    n_times = int(duration * staging.STAGING_SFREQ)
+    envelope = 1 + 0.5 * np.sin(np.linspace(0, 6 * np.pi, n_times))
+    data = rng.normal(scale=20e-6, size=(len(channels), n_times)) * envelope
+    return mne.io.RawArray(data, info)
+
+
+raw = make_raw(args.duration, args.seed)
+sls = yasa.SleepStaging(raw, eeg_name=channels["eeg"], eog_name=channels["eog"], emg_name=channels["emg"],
+    metadata=metadata)
+reference = sls.get_features()
+
+data = mne.filter.filter_data(sls.data, sls.sf, *staging.STAGING_FREQS, verbose=False)
+base = []
+for i, ch_type in enumerate(channels):
+    _, epochs = yasa.sliding_window(data[i], sf=sls.sf, window=staging.EPOCH_LENGTH)
+    base.append(staging.epoch_features(epochs, ch_type))
+features = staging.finish_features(pd.concat(base, axis=1), metadata=metadata)
+
+missing = sorted(set(reference.columns).symmetric_difference(features.columns))
+columns = sorted(set(reference.columns) & set(features.columns))
+error = (features[columns] - reference[columns]).abs() / reference[columns].abs().max().replace(0, 1)
+worst = error.max().sort_values(ascending=False)
+
+print(f"Columns in only one of them: {missing}")
+print(f"Max relative error: {worst.iloc[0]:.3g} ({worst.index[0]})")
+print(f"Max relative error, *_p2min_norm: {worst.filter(like='_p2min_norm').max():.3g}")
+if missing or worst.iloc[0] > 1e-5:
+    sys.exit("finish_features does not match SleepStaging.get_features")
@@ -0,0 +1,168 @@
+"""Hypnogram events tables (calc-hypno.py output): built from staged epochs, read back compactly.
+
+Stages are stored as YASA's integer codes (``value``, uint8) next to their
+labels (``description``, a categorical with fixed ``utils.SLEEP_STAGES``
+categories, so its codes are the same integers), and stage probabilities
+as float32.
+"""
+
+import numpy as np
+import pandas as pd
+
+import utils
+
+
+STAGE_DTYPE = utils.TSV_SCHEMAS["hypno"]["description"]
+# Classifier column order (alphabetical).
+PROBA_STAGES = sorted(utils.SLEEP_STAGES)
+PROBA_COLUMNS = [f"proba_{s}" for s in PROBA_STAGES]
+
+SIDECAR = {
+    "onset": {
+        "LongName": "Onset (in seconds) of the event",
+        "Description": "Onset (in seconds) of the event"
+    },
+    "duration": {
+        "LongName": "Duration of the event (measured from onset) in seconds",
+        "Description": "Duration of the event (measured from onset) in seconds"
+    },
+    "value": {
+        "LongName": "Marker/trigger value associated with the event",
+        "Description": "Marker/trigger value associated with the event",
+        "Levels": {str(i): stage for i, stage in enumerate(utils.SLEEP_STAGES)},
+    },
+    "description": {
+        "LongName": "Value description",
+        "Description": "Readable explanation of value markers column"
+    },
+    "scorer": {},
+    "eeg_channel": {},
+    "eog_channel": {},
+    "emg_channel": {},
+    "epoch": {},
+} | {
+    f"proba_{x}": {
+        "LongName": f"Probability of {x}",
+        "Description": f"YASA's estimation of {x} likelihood"
+    }
+    for x in PROBA_STAGES
+}
+
+
+def encode(stages):
+    """Stage labels ("W", "N1", ...) to uint8 codes, integer codes pass through."""
+    stages = np.asarray(stages)
+    if stages.dtype.kind in "iu":
+        codes = stages
+    else:
+        codes = pd.Categorical(stages, dtype=STAGE_DTYPE).codes
+    assert ((codes >= 0) & (codes < len(utils.SLEEP_STAGES))).all(), "Unknown sleep stage"
+    return codes.astype(np.uint8)
+
+def to_events(stages, proba=None, first_epoch=0, epoch_length=utils.EPOCH_LENGTH, **columns):
+    """BIDS events frame of a staged hypnogram.
+
+    Parameters
+    ----------
+    stages : array-like
+        Stage of each epoch, as labels or integer codes.
+    proba : pandas.DataFrame or array-like, optional
+        ``(n_epochs, n_stages)`` probabilities, DataFrame columns named by
+        stage or array columns in ``PROBA_STAGES`` order.
+    first_epoch : int
+        Index of the first epoch (for a hypnogram staged in parts).
+    epoch_length : int
+        Epoch length in seconds.
+    **columns
+        Constant columns (e.g., ``scorer``, ``eeg_channel``).
+    """
+    codes = encode(stages)
+    epoch = np.arange(first_epoch, first_epoch + codes.size)
+    events = pd.DataFrame({
+        "onset": epoch * epoch_length,
+        "duration": np.full(codes.size, epoch_length),
+        "value": codes,
+        "description": pd.Categorical.from_codes(codes, dtype=STAGE_DTYPE),
+        **columns,
+        "epoch": epoch,
+    })
+    if proba is not None:
+        if isinstance(proba, pd.DataFrame):
+            proba = proba[PROBA_STAGES]
+        proba = np.asarray(proba, dtype=np.float32)
+        events = events.join(pd.DataFrame(proba, columns=PROBA_COLUMNS))
+    return events
+
+def read_hypno(filepath):
+    """Read a hypnogram events file with its compact dtypes (see ``utils.TSV_SCHEMAS``)."""
+    return utils.read_tsv(filepath, suffix="hypno")
+
+def stage_overlap(hypno, events, keys):
+    """Seconds each event spends in each sleep stage, for many recordings at once.
+
+    All hypnograms are laid end to end on one time axis and their epochs
+    form a sorted, non-overlapping interval index. Cumulative seconds per
+    stage are precomputed at each epoch start, so the time an event spends
+    in each stage is the difference of that cumulative function at its end
+    and onset, found by binary search on the interval starts. Events are
+    clipped to their own hypnogram. Point events (zero duration) get zero
+    seconds but still have an onset epoch.
+
+    Parameters
+    ----------
+    hypno : pandas.DataFrame
+        Stacked hypnograms: the ``keys`` columns plus ``onset``, ``duration``
+        and ``value`` (stage code).
+    events : pandas.DataFrame
+        Stacked events of the same recordings: the ``keys`` columns plus
+        ``onset`` and ``duration`` (missing durations count as zero).
+    keys : list of str
+        Columns identifying a recording, e.g. participant and acquisition.
+
+    Returns
+    -------
+    seconds : pandas.DataFrame
+        Seconds in each stage (columns ``utils.SLEEP_STAGES``), indexed like ``events``.
+    onset_epoch : numpy.ndarray
+        Position (row number) in ``hypno`` of the epoch containing each
+        event's onset, -1 if the onset is outside its recording's hypnogram.
+    """
+    n_stages = len(utils.SLEEP_STAGES)
+    end = hypno["onset"] + hypno["duration"]
+    bounds = hypno.assign(end=end).groupby(keys, observed=True).agg(start=("onset", "min"), end=("end", "max"))
+    # Shift each recording to start where the previous one ended.
+    bounds["offset"] = (bounds["end"] - bounds["start"]).cumsum().shift(fill_value=0) - bounds["start"]
+
+    offset = hypno[keys].join(bounds["offset"], on=keys)["offset"].to_numpy()
+    starts = hypno["onset"].to_numpy() + offset
+    order = np.argsort(starts, kind="stable")
+    starts = starts[order]
+    durations = hypno["duration"].to_numpy()[order]
+    codes = hypno["value"].to_numpy()[order].astype(np.intp)
+    stage_time = np.zeros((starts.size, n_stages))
+    stage_time[np.arange(starts.size), codes] = durations
+    # Seconds in each stage before each epoch starts.
+    cumulative = np.cumsum(stage_time, axis=0) - stage_time
+
+    def locate(t):
+        k = (np.searchsorted(starts, t, side="right") - 1).clip(0)
+        return k, t - starts[k]
+
+    def stage_time_at(t):
+        k, elapsed = locate(t)
+        elapsed = np.clip(elapsed, 0, durations[k])
+        return cumulative[k] + elapsed[:, None] * (codes[k][:, None] == np.arange(n_stages))
+
+    e = events[keys].join(bounds, on=keys)
+    known = e["offset"].notna().to_numpy()
+    onset = events["onset"].to_numpy(dtype=float)
+    stop = onset + events["duration"].fillna(0).to_numpy(dtype=float)
+    e_start, e_end, e_offset = (e[c].fillna(0).to_numpy(dtype=float) for c in ["start", "end", "offset"])
+    a = np.clip(onset, e_start, e_end) + e_offset
+    b = np.clip(stop, e_start, e_end) + e_offset
+    seconds = pd.DataFrame(stage_time_at(b) - stage_time_at(a), index=events.index, columns=utils.SLEEP_STAGES)
+
+    k, elapsed = locate(onset + e_offset)
+    inside = known & (onset >= e_start) & (onset < e_end) & (elapsed >= 0) & (elapsed < durations[k])
+    onset_epoch = np.where(inside, order[k], -1)
+    return seconds, onset_epoch
@@ -2,9 +2,7 @@
 import argparse
 from pathlib import Path
 
-from bids import BIDSLayout
 import numpy as np
-import pandas as pd
 import pingouin as pg
 
 import matplotlib.pyplot as plt
@@ -21,23 +19,8 @@ plt.rcParams["font.sans-serif"] = "Arial"
 export_path = utils.DERIVATIVES_DIR / "lucidity.png"
 export_path_table = utils.DERIVATIVES_DIR / "lucidity.tsv"
 
-layout = BIDSLayout(utils.ROOT_DIR, validate=False)
-
-bids_files = layout.get(
-    task="sleep",
-    suffix="rep",
-    extension=".tsv",
-)
-
 # Stack all participants into one dataframe.
-subject_dataframes = []
-for bf in bids_files:
-    ### THIS IS USED A LOT, SHOULD BE UTILITY (loading and adding subject or other entities to df)
-    participant_id = "sub-" + bf.entities["subject"]
-    acquisition_id = "acq-" + bf.entities["acquisition"]
-    sub_df = bf.get_df().assign(participant_id=participant_id)
-    subject_dataframes.append(sub_df)
-df = pd.concat(subject_dataframes).set_index(["participant_id", "awakening_id"])
+df = utils.load_group(task="sleep", suffix="rep").set_index(["participant_id", "awakening_id"])
 
 # drop subject 906, too early
 df = df.drop("sub-906")
@@ -48,7 +31,7 @@ df = df.drop("sub-907")
 df = df.query("Recall.eq(2)")
 
 
-ser = df.groupby("participant_id")["Lucidity"].max().ge(3).rename("had_lucid")
+ser = df.groupby("participant_id", observed=True)["Lucidity"].max().ge(3).rename("had_lucid")
 utils.export_tsv(ser, export_path_table)
 
 x = ser.to_numpy()
@@ -7,6 +7,7 @@ from bids import BIDSLayout
 import mne
 import pandas as pd
 
+import psg
 import utils
 
 import dmlab
@@ -71,22 +72,8 @@ for eeg_path in nap_paths:
     ############################################################
     # Apply a bandpass filter to each channel.
 
-    filter_params = dict(filter_length="auto", method="fir")
-    filter_cutoffs = { # from AASM guidelines
-        "eeg": (0.3, 35), # Hz; Low-cut, High-cut
-        "eog": (0.3, 35),
-        "emg": (10, 100),
-        "ecg": (0.3, 70),
-        "snoring": (10, 100),
-        "respiration": (0.1, 15),
-    }
-
-    raw.filter(*filter_cutoffs["eeg"], picks="eeg", **filter_params)
-    raw.filter(*filter_cutoffs["eog"], picks="eog", **filter_params)
-    raw.filter(*filter_cutoffs["emg"], picks="emg", **filter_params)
-    # raw.filter(*filter_cutoffs["ecg"], picks="ecg", **filter_params)
-    raw.filter(*filter_cutoffs["snoring"], picks="Snoring", **filter_params)
-    raw.filter(*filter_cutoffs["respiration"], picks=["RESP", "Airflow"], **filter_params)
+    raw.load_data()
+    psg.FilterBank(utils.FILTER_CUTOFFS, utils.FILTER_PICKS, utils.FILTER_PARAMS).apply_raw(raw)
 
 
     ############################################################
@@ -8,9 +8,9 @@ from pathlib import Path
 
 from bids import BIDSLayout
 import mne
-import pandas as pd
 import yasa
 
+import hypnogram
 import utils
 
 import dmlab
@@ -99,15 +99,7 @@ for eeg_path in nap_paths:
     # print(hypnogram_str_w_art)
 
     # Generate events dataframe for hypnogram.
-    epoch_length = 30
-    hypnogram_int = yasa.hypno_str_to_int(hypnogram_str)
-    hypnogram_events = {
-        "onset": [ epoch_length*i for i in range(len(hypnogram_str)) ],
-        "duration": [ epoch_length for i in range(len(hypnogram_str)) ],
-        "value" : hypnogram_int,
-        "description" : hypnogram_str,
-    }
-    hypnogram_df = pd.DataFrame.from_dict(hypnogram_events)
+    hypnogram_df = hypnogram.to_events(hypnogram_str)
 
     # Export.
     dmlab.io.export_dataframe(hypnogram_df, hypnogram_path)
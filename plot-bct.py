@@ -1,56 +1,40 @@
 """Plot all BCT presses of all participants.
 """
-from bids import BIDSLayout
 from matplotlib.collections import LineCollection
 import matplotlib.pyplot as plt
 import numpy as np
-import pandas as pd
 import pingouin as pg
 
 import utils
 
 
-bids_root = utils.ROOT_DIR
 derivatives_dir = utils.DERIVATIVES_DIR
 
 export_path = derivatives_dir / "task-bct.png"
 export_path_table = derivatives_dir / "task-bct.tsv"
 
 
-layout = BIDSLayout(bids_root)
-
-bids_files = layout.get(
+# Stack all participants into one dataframe.
+df = utils.load_group(
+    entities=["subject", "acquisition"],
     task="bct",
     acquisition=["pre", "post"],
     suffix="beh",
-    extension=".tsv",
-)
-
-# Stack all participants into one dataframe.
-subject_dataframes = []
-for bf in bids_files:
-    participant_id = "sub-" + bf.entities["subject"]
-    acquisition_id = "acq-" + bf.entities["acquisition"]
-    sub_df = bf.get_df(
-        ).assign(participant_id=participant_id, acquisition_id=acquisition_id
-        ).set_index(["participant_id", "acquisition_id"])
-    subject_dataframes.append(sub_df)
-
-df = pd.concat(subject_dataframes)
+).set_index(["participant_id", "acquisition_id"])
 
 df["rt_diff"] = (df
-    .groupby(["participant_id", "acquisition_id", "cycle"])
+    .groupby(["participant_id", "acquisition_id", "cycle"], observed=True)
     ["timestamp"].diff()
 )
 desc = (df
-    .groupby(["participant_id", "acquisition_id", "cycle"])
+    .groupby(["participant_id", "acquisition_id", "cycle"], observed=True)
     .agg({"accuracy": ["count", "last"], "rt_diff": ["mean", "std"]})
 )
 desc.columns = ["n", "accuracy", "rt_mean", "rt_std"]
 
-accuracy = desc["accuracy"].eq("correct").groupby(["participant_id", "acquisition_id"]).mean()
+accuracy = desc["accuracy"].eq("correct").groupby(["participant_id", "acquisition_id"], observed=True).mean()
 
-acc = accuracy.to_frame().reset_index()
+acc = accuracy.to_frame().reset_index().astype({"participant_id": str, "acquisition_id": str})
 table = acc.pivot(index="participant_id", columns="acquisition_id", values="accuracy")
 table = table.dropna()
 
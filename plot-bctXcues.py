@@ -1,11 +1,9 @@
 """Plot all BCT presses of all participants.
 """
-from bids import BIDSLayout
 from matplotlib.collections import LineCollection
 import matplotlib.pyplot as plt
 import seaborn as sns
 import numpy as np
-import pandas as pd
 import pingouin as pg
 
 import utils
@@ -14,72 +12,50 @@ import utils
 utils.set_matplotlib_style()
 
 
-bids_root = utils.ROOT_DIR
 derivatives_dir = utils.DERIVATIVES_DIR
 
 export_path = derivatives_dir / "task-bctXcues.png"
 
 
-layout = BIDSLayout(bids_root)
-
-bids_files = layout.get(
+# Stack all participants into one dataframe.
+df = utils.load_group(
+    entities=["subject", "acquisition"],
     task="bct",
     acquisition=["pre", "post"],
     suffix="beh",
-    extension=".tsv",
-)
-
-# Stack all participants into one dataframe.
-subject_dataframes = []
-for bf in bids_files:
-    participant_id = "sub-" + bf.entities["subject"]
-    acquisition_id = "acq-" + bf.entities["acquisition"]
-    sub_df = bf.get_df(
-        ).assign(participant_id=participant_id, acquisition_id=acquisition_id
-        ).set_index(["participant_id", "acquisition_id"])
-    subject_dataframes.append(sub_df)
-
-df = pd.concat(subject_dataframes)
+).set_index(["participant_id", "acquisition_id"])
 
 df["rt_diff"] = (df
-    .groupby(["participant_id", "acquisition_id", "cycle"])
+    .groupby(["participant_id", "acquisition_id", "cycle"], observed=True)
     ["timestamp"].diff()
 )
 desc = (df
-    .groupby(["participant_id", "acquisition_id", "cycle"])
+    .groupby(["participant_id", "acquisition_id", "cycle"], observed=True)
     .agg({"accuracy": ["count", "last"], "rt_diff": ["mean", "std"]})
 )
 desc.columns = ["n", "accuracy", "rt_mean", "rt_std"]
 
-accuracy = desc["accuracy"].eq("correct").groupby(["participant_id", "acquisition_id"]).mean()
+accuracy = desc["accuracy"].eq("correct").groupby(["participant_id", "acquisition_id"], observed=True).mean()
 
-acc = accuracy.to_frame().reset_index()
+acc = accuracy.to_frame().reset_index().astype({"participant_id": str, "acquisition_id": str})
 table = acc.pivot(index="participant_id", columns="acquisition_id", values="accuracy")
 table = table.dropna().rename_axis(columns=None).sort_index(axis=1, ascending=False)
 table["diff"] = table["acq-post"].sub(table["acq-pre"])
 table_desc = table.describe().T.join(table.sem().rename("sem"))
 
 
-layout2 = BIDSLayout(bids_root, derivatives=True)
-bids_files2 = layout2.get(
+# Stack all participants into one dataframe.
+df2 = utils.load_group(
+    entities=["subject", "acquisition"],
+    columns=["frequency"],
+    derivatives=True,
     task="sleep",
     acquisition="nap",
     suffix="cues",
-    extension=".tsv",
-)
+).set_index(["participant_id", "acquisition_id"])
 
-# Stack all participants into one dataframe.
-subject_dataframes2 = []
-for bf in bids_files2:
-    participant_id = "sub-" + bf.entities["subject"]
-    acquisition_id = "acq-" + bf.entities["acquisition"]
-    sub_df = bf.get_df(
-        ).assign(participant_id=participant_id, acquisition_id=acquisition_id
-        ).set_index(["participant_id", "acquisition_id"])
-    subject_dataframes2.append(sub_df)
-df2 = pd.concat(subject_dataframes2)
-
-n_cues = df2.groupby("participant_id")["frequency"].sum().rename("n_cues")
+n_cues = df2.groupby("participant_id", observed=True)["frequency"].sum().rename("n_cues")
+n_cues.index = n_cues.index.astype(str)
 
 dat = table.join(n_cues, how="outer")
 dat = dat.dropna()
@@ -1,11 +1,9 @@
 """Plot rrv somehow.
 """
-from bids import BIDSLayout
 from matplotlib.collections import LineCollection
 import matplotlib.pyplot as plt
 import seaborn as sns
 import numpy as np
-import pandas as pd
 import pingouin as pg
 
 import utils
@@ -14,35 +12,25 @@ import utils
 utils.set_matplotlib_style()
 
 
-bids_root = utils.ROOT_DIR
 derivatives_dir = utils.DERIVATIVES_DIR
 
 export_path = derivatives_dir / "rrv.png"
 
+resp_channel = "Airflow"
 
-layout = BIDSLayout(bids_root, derivatives=True)
 
-bids_files = layout.get(
+# Stack all participants into one dataframe.
+df = utils.load_group(
+    derivatives=True,
     task="sleep",
     acquisition="nap",
-    suffix="resp",
-    extension=".tsv",
-)
-
-# Stack all participants into one dataframe.
-subject_dataframes = []
-for bf in bids_files:
-    ### THIS IS USED A LOT, SHOULD BE UTILITY (loading and adding subject or other entities to df)
-    participant_id = "sub-" + bf.entities["subject"]
-    acquisition_id = "acq-" + bf.entities["acquisition"]
-    sub_df = bf.get_df().assign(participant_id=participant_id)
-    subject_dataframes.append(sub_df)
-
-df = pd.concat(subject_dataframes)#.set_index(["participant_id", "cue", "location"])
+    suffix="rrv",
+)#.set_index(["participant_id", "cue", "location"])
+df = df.query("channel == @resp_channel").drop(columns="channel")
 
 
 # Average across all cues for each participant
-df = df.groupby(["participant_id", "location"]).mean().drop(columns="cue")
+df = df.groupby(["participant_id", "location"], observed=True).mean().drop(columns="cue")
 # drop columns/measures that not all participants have
 df = df.dropna(axis="columns")
 # df = df.reset_index()
@@ -67,9 +55,6 @@ plot_measures = [
     "RRV_MedianBB",
     "RRV_MadBB",
     "RRV_MCVBB",
-    "RRV_LF",
-    "RRV_HF",
-    "RRV_LFHF",
     # "RRV_SD1",
     # "RRV_SD2",
     # "RRV_SD2SD1",
@@ -97,7 +82,7 @@ utils.export_mpl(export_path)
 
 
 desc = (df
-    .groupby("location")
+    .groupby("location", observed=True)
     .agg(["count", "min", "max", "median", "mean", "std", "sem"])
     .stack(0)
     .rename_axis(["location", "measure"])
@@ -0,0 +1,596 @@
+"""PSG signal helpers shared by the EEG scripts (filtering, resampling, storage, export)."""
+
+from fractions import Fraction
+from functools import lru_cache
+import json
+import math
+from pathlib import Path
+import tempfile
+
+import mne
+import numpy as np
+from scipy import signal
+
+import utils
+
+
+mne.set_log_level(verbose=utils.MNE_VERBOSITY)
+
+
+################################################################################
+# FILTER BANK
+################################################################################
+
+
+def _resolve_picks(ch_names, ch_types, picks):
+    """Return channel indices for a channel type ("eeg"), name, or list of names."""
+    if isinstance(picks, str):
+        if picks in ch_types:
+            return [i for i, t in enumerate(ch_types) if t == picks]
+        picks = [picks]
+    return [ch_names.index(ch) for ch in picks if ch in ch_names]
+
+@lru_cache(maxsize=None)
+def design_kernel(sfreq, l_freq, h_freq, filter_params=()):
+    """Design (and remember) a zero-phase FIR band-pass kernel.
+
+    ``filter_params`` is a sorted tuple of ``(key, value)`` pairs so the
+    call is hashable. Kernels are cached for the life of the process, so
+    they are only designed once across participants and segments.
+    """
+    h = mne.filter.create_filter(None, sfreq, l_freq, h_freq, **dict(filter_params))
+    h.setflags(write=False)
+    return h
+
+
+class FilterBank:
+    """Band-pass filters keyed by channel group, applied in one FFT pass.
+
+    Parameters
+    ----------
+    cutoffs : dict
+        ``{band: (l_freq, h_freq)}``, see ``utils.FILTER_CUTOFFS``.
+    picks : dict
+        ``{band: picks}`` where picks is a channel type, channel name, or
+        list of channel names, see ``utils.FILTER_PICKS``.
+    filter_params : dict
+        Extra keyword arguments for :func:`mne.filter.create_filter`.
+    """
+
+    def __init__(self, cutoffs=None, picks=None, filter_params=None):
+        self.cutoffs = utils.FILTER_CUTOFFS if cutoffs is None else cutoffs
+        self.picks = utils.FILTER_PICKS if picks is None else picks
+        self.filter_params = utils.FILTER_PARAMS if filter_params is None else filter_params
+
+    def kernels(self, sfreq):
+        """Return ``{band: kernel}`` for a sampling frequency."""
+        params = tuple(sorted(self.filter_params.items()))
+        return {
+            band: design_kernel(float(sfreq), l_freq, h_freq, params)
+            for band, (l_freq, h_freq) in self.cutoffs.items()
+        }
+
+    def kernel_matrix(self, sfreq, ch_names, ch_types):
+        """Stack each channel's kernel into one ``(n_filtered, n_taps)`` matrix.
+
+        Shorter kernels are zero-padded on both sides, which keeps them
+        centered (and zero-phase). Channels not covered by any band are left out.
+        """
+        kernels = self.kernels(sfreq)
+        rows, row_kernels = [], []
+        for band, h in kernels.items():
+            for idx in _resolve_picks(ch_names, ch_types, self.picks[band]):
+                rows.append(idx)
+                row_kernels.append(h)
+        n_taps = max((h.size for h in row_kernels), default=1)
+        matrix = np.zeros((len(rows), n_taps))
+        for i, h in enumerate(row_kernels):
+            offset = (n_taps - h.size) // 2
+            matrix[i, offset:offset + h.size] = h
+        return rows, matrix
+
+    def apply(self, data, sfreq, ch_names, ch_types):
+        """Filter a ``(n_channels, n_times)`` array in place and return it."""
+        rows, matrix = self.kernel_matrix(sfreq, ch_names, ch_types)
+        if rows:
+            data[rows] = _apply_fir(data[rows], matrix)
+        return data
+
+    def apply_raw(self, raw):
+        """Filter a preloaded Raw in place (replaces one ``raw.filter`` per band)."""
+        sfreq = raw.info["sfreq"]
+        ch_names = raw.ch_names
+        ch_types = raw.get_channel_types()
+        raw.apply_function(
+            lambda data: self.apply(data, sfreq, ch_names, ch_types),
+            picks="all",
+            channel_wise=False,
+        )
+        return raw
+
+
+def _apply_fir(data, kernels):
+    """Zero-phase FIR filtering of each row with its own kernel.
+
+    Edges are padded like MNE's default ``pad="reflect_limited"``: odd
+    reflection (``2 * x[0] - x[n:0:-1]``) up to the signal length, zeros
+    beyond it. Uses overlap-add, so the FFTs are the size of a few kernel
+    lengths rather than the whole recording (which peaks at several GB overnight).
+    """
+    kernels = np.atleast_2d(kernels)
+    n_pad = kernels.shape[-1] // 2
+    n_reflect = min(n_pad, data.shape[-1] - 1)
+    padded = np.pad(data, ((0, 0), (n_reflect, n_reflect)), mode="reflect", reflect_type="odd")
+    padded = np.pad(padded, ((0, 0), (n_pad - n_reflect, n_pad - n_reflect)))
+    filtered = signal.oaconvolve(padded, kernels, mode="same", axes=-1)
+    return filtered[:, n_pad:n_pad + data.shape[-1]]
+
+
+################################################################################
+# STREAMING FILTER AND RESAMPLE
+################################################################################
+
+
+def stream_filter_resample(
+        raw,
+        filter_bank,
+        sfreq,
+        reference="average",
+        block_duration=600,
+    ):
+    """Re-reference, band-pass filter and downsample a Raw in overlapping blocks.
+
+    Works on a lazily-loaded (``preload=False``) Raw, so only one block of
+    native-rate samples is in memory at a time. Each block is read with
+    enough padding on both sides to cover the filter and anti-aliasing
+    kernels, the whole filter bank is applied, the block is decimated with
+    a polyphase resampler and only the unpadded middle is written out.
+
+    The output doesn't depend on ``block_duration`` (block seams are
+    exact), but it isn't the same as filtering and then calling
+    ``raw.resample``: ``scipy.signal.resample_poly`` has a different
+    anti-aliasing filter than MNE's FFT resampling. Expect differences of
+    about 1% on EEG and over 10% on channels whose band reaches past the
+    new Nyquist frequency (EMG, Snoring).
+
+    Parameters
+    ----------
+    raw : mne.io.Raw
+        Recording to process, usually cropped to a single task window.
+    filter_bank : FilterBank
+        Band-pass filters to apply to each channel group.
+    sfreq : float
+        Output sampling frequency.
+    reference : str or None
+        If "average", EEG channels are re-referenced to their average.
+    block_duration : float
+        Length (in seconds) of each block before padding.
+
+    Returns
+    -------
+    mne.io.RawArray
+        Preloaded Raw at ``sfreq`` with the same channels.
+    """
+    sfreq_in = raw.info["sfreq"]
+    n_times = raw.n_times
+    n_channels = len(raw.ch_names)
+    ch_types = raw.get_channel_types()
+    ratio = Fraction(sfreq / sfreq_in).limit_denominator(1000)
+    up, down = ratio.numerator, ratio.denominator
+
+    # Kernels are designed once (and cached), then reused for every block.
+    rows, matrix = filter_bank.kernel_matrix(sfreq_in, raw.ch_names, ch_types)
+    eeg_picks = _resolve_picks(raw.ch_names, ch_types, "eeg") if reference == "average" else []
+
+    # Padding has to cover half the longest filter plus the resampler kernel,
+    # and stay a multiple of the decimation factor to keep output samples aligned.
+    pad = matrix.shape[-1] // 2 + 10 * max(up, down)
+    pad = int(np.ceil(pad / down) * down)
+    block_size = int(np.ceil(block_duration * sfreq_in / down) * down)
+
+    n_out = int(np.ceil(n_times * up / down))
+    out = np.empty((n_channels, n_out), dtype=np.float64)
+    for start in range(0, n_times, block_size):
+        stop = min(start + block_size, n_times)
+        read_start = max(start - pad, 0)
+        read_stop = min(stop + pad, n_times)
+        data = raw.get_data(start=read_start, stop=read_stop)
+        if eeg_picks:
+            data[eeg_picks] -= data[eeg_picks].mean(axis=0, keepdims=True)
+        if rows:
+            data[rows] = _apply_fir(data[rows], matrix)
+        data = signal.resample_poly(data, up, down, axis=-1)
+        # Keep only the samples that belong to this block.
+        offset = (start - read_start) * up // down
+        out_start = start * up // down
+        out_stop = n_out if stop == n_times else stop * up // down
+        out[:, out_start:out_stop] = data[:, offset:offset + out_stop - out_start]
+
+    info = raw.info.copy()
+    with info._unlock():
+        info["sfreq"] = float(sfreq)
+        info["lowpass"] = min(info["lowpass"], sfreq / 2)
+        if eeg_picks:
+            info["custom_ref_applied"] = mne.io.constants.FIFF.FIFFV_MNE_CUSTOM_REF_ON
+    return mne.io.RawArray(out, info)
+
+
+################################################################################
+# MEMORY-MAPPED SAMPLE STORE
+################################################################################
+
+
+def derivative_path(edf_path, extension):
+    """Map a raw ``*_eeg.edf`` path to its sibling under derivatives/."""
+    edf_path = Path(edf_path)
+    participant_id = edf_path.name.split("_")[0]
+    return utils.DERIVATIVES_DIR / participant_id / edf_path.with_suffix(extension).name
+
+def fresh_store(edf_path, extension):
+    """Path of a derivative store of ``edf_path`` if it exists and isn't older than the EDF.
+
+    Guards against reading a store left over from an earlier export.
+    """
+    store_path = derivative_path(edf_path, extension)
+    if store_path.exists() and store_path.stat().st_mtime_ns >= Path(edf_path).stat().st_mtime_ns:
+        return store_path
+    return None
+
+def write_samples(raw, filepath, block_size=360000):
+    """Write a Raw's samples to a float32 ``.npy`` file plus a JSON header.
+
+    The array is ``(n_channels, n_times)`` in Volts and is written block by
+    block through a memory map. The header (``.json`` next to it) carries
+    the channel names, types and sampling frequency.
+    """
+    filepath = Path(filepath)
+    filepath.parent.mkdir(parents=True, exist_ok=True)
+    shape = (len(raw.ch_names), raw.n_times)
+    arr = np.lib.format.open_memmap(filepath, mode="w+", dtype=np.float32, shape=shape)
+    for start in range(0, raw.n_times, block_size):
+        stop = min(start + block_size, raw.n_times)
+        arr[:, start:stop] = raw.get_data(start=start, stop=stop)
+    arr.flush()
+    del arr
+    header = {
+        "ch_names": raw.ch_names,
+        "ch_types": raw.get_channel_types(),
+        "sfreq": raw.info["sfreq"],
+        "n_times": raw.n_times,
+        "units": "V",
+    }
+    utils.export_json(header, filepath.with_suffix(".json"))
+
+def open_samples(filepath):
+    """Open a sample store zero-copy, returns the ``(n_channels, n_times)`` memmap and header."""
+    filepath = Path(filepath)
+    data = np.load(filepath, mmap_mode="r")
+    header = utils.import_json(filepath.with_suffix(".json"))
+    return data, header
+
+def read_samples(filepath, picks=None, tmin=None, tmax=None):
+    """Slice a sample store by channel name(s) and time (seconds).
+
+    Only the requested rows/columns are paged in from disk.
+    """
+    data, header = open_samples(filepath)
+    sfreq = header["sfreq"]
+    start = None if tmin is None else int(round(tmin * sfreq))
+    stop = None if tmax is None else int(round(tmax * sfreq))
+    if picks is None:
+        return data[:, start:stop]
+    picks = [picks] if isinstance(picks, str) else picks
+    rows = [header["ch_names"].index(ch) for ch in picks]
+    return data[rows, start:stop]
+
+def read_raw(edf_path, picks=None):
+    """Load a preprocessed recording, preferring the fastest store available.
+
+    Tries the columnar store, then the memory-mapped store, and falls back
+    to decoding the EDF when no derivative store was written (or it is
+    older than the EDF).
+    Returns a preloaded Raw restricted to ``picks``.
+    """
+    columnar_path = fresh_store(edf_path, ".parquet")
+    if columnar_path is not None:
+        data, header = read_columnar(columnar_path, picks=picks)
+        info = mne.create_info(header["ch_names"], header["sfreq"], header["ch_types"])
+        return mne.io.RawArray(data.astype(np.float64), info)
+    store_path = fresh_store(edf_path, ".npy")
+    if store_path is not None:
+        data, header = open_samples(store_path)
+        picks = header["ch_names"] if picks is None else picks
+        rows = [header["ch_names"].index(ch) for ch in picks]
+        info = mne.create_info(
+            [header["ch_names"][i] for i in rows],
+            header["sfreq"],
+            [header["ch_types"][i] for i in rows],
+        )
+        return mne.io.RawArray(np.asarray(data[rows], dtype=np.float64), info)
+    raw = mne.io.read_raw_edf(edf_path)
+    if picks is not None:
+        raw.pick(picks)
+    return raw.load_data()
+
+
+################################################################################
+# COLUMNAR SAMPLE STORE
+################################################################################
+
+
+def write_columnar(raw, filepath, chunk_duration=600, compression="zstd"):
+    """Write a Raw's samples to a compressed Parquet file, one column per channel.
+
+    Each row group holds ``chunk_duration`` seconds, so readers can pull a
+    single channel and/or time range without decoding the rest. Samples are
+    float32 in Volts; channel types and sampling frequency go in the file
+    metadata. Requires ``pyarrow``.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    filepath = Path(filepath)
+    filepath.parent.mkdir(parents=True, exist_ok=True)
+    header = {
+        "ch_types": raw.get_channel_types(),
+        "sfreq": raw.info["sfreq"],
+        "n_times": raw.n_times,
+        "units": "V",
+    }
+    schema = pa.schema(
+        [pa.field(ch, pa.float32()) for ch in raw.ch_names],
+        metadata={"psg": json.dumps(header)},
+    )
+    chunk_size = int(chunk_duration * raw.info["sfreq"])
+    with pq.ParquetWriter(filepath, schema, compression=compression) as writer:
+        for start in range(0, raw.n_times, chunk_size):
+            stop = min(start + chunk_size, raw.n_times)
+            data = raw.get_data(start=start, stop=stop).astype(np.float32)
+            writer.write_table(pa.Table.from_arrays(list(data), schema=schema), row_group_size=chunk_size)
+
+def read_columnar(filepath, picks=None, tmin=None, tmax=None):
+    """Read channel(s) and a time range (seconds) from a columnar store.
+
+    Only the requested columns of the overlapping row groups are decoded.
+    Returns the ``(n_channels, n_times)`` float32 array and the header, with
+    ``ch_names`` set to the channels returned.
+    """
+    import pyarrow.parquet as pq
+    pf = pq.ParquetFile(filepath)
+    header = json.loads(pf.schema_arrow.metadata[b"psg"])
+    ch_names = pf.schema_arrow.names
+    picks = ch_names if picks is None else [picks] if isinstance(picks, str) else list(picks)
+    sfreq = header["sfreq"]
+    start = 0 if tmin is None else int(round(tmin * sfreq))
+    stop = header["n_times"] if tmax is None else int(round(tmax * sfreq))
+    # Locate the row groups overlapping [start, stop).
+    group_sizes = [pf.metadata.row_group(i).num_rows for i in range(pf.num_row_groups)]
+    group_starts = np.concatenate([[0], np.cumsum(group_sizes)])
+    groups = [i for i in range(pf.num_row_groups) if group_starts[i] < stop and group_starts[i + 1] > start]
+    table = pf.read_row_groups(groups, columns=picks)
+    offset = group_starts[groups[0]] if groups else 0
+    data = np.stack([table.column(ch).to_numpy() for ch in picks])
+    header["ch_types"] = [header["ch_types"][ch_names.index(ch)] for ch in picks]
+    header["ch_names"] = picks
+    return data[:, start - offset:stop - offset], header
+
+
+################################################################################
+# EDF EXPORT
+################################################################################
+
+
+# Same conventions as mne.export.export_raw (written with edfio): voltage
+# channels are written in uV and the other channels unscaled with an empty
+# unit, physical range is shared by each channel type, 16-bit symmetric digital range.
+EDF_UV_TYPES = ["eeg", "ecog", "seeg", "eog", "ecg", "emg", "bio", "dbs"]
+EDF_DIGITAL_RANGE = (-32767, 32767)
+EDF_ANNOTATIONS_LABEL = "EDF Annotations"
+EDF_MONTHS = ["JAN", "FEB", "MAR", "APR", "MAY", "JUN", "JUL", "AUG", "SEP", "OCT", "NOV", "DEC"]
+
+
+def _edf_field(value, width):
+    """Left-justified, space-padded ASCII header field."""
+    value = str(value)
+    if len(value) > width:
+        raise ValueError(f"EDF header field '{value}' is longer than {width} characters")
+    return value.ljust(width).encode("ascii")
+
+def _edf_number(value):
+    """Header representation of a number (without decimals when it is an integer)."""
+    value = float(value)
+    return str(int(value)) if value.is_integer() else str(value)
+
+def _edf_bound(value, upper):
+    """Round a physical bound outward to fit an 8-character field, as edfio does."""
+    value = float(value)
+    if not value.is_integer():
+        round_out = math.ceil if upper else math.floor
+        integer_length = str(value).find(".")
+        if integer_length == 8:
+            value = round_out(value)
+        else:
+            factor = 10 ** (8 - 1 - integer_length)
+            value = round_out(value * factor) / factor
+    return _edf_number(value)
+
+def _edf_date(date):
+    """EDF+ date subfield (e.g., 14-NOV-2023), X when unknown."""
+    if date is None:
+        return "X"
+    return f"{date.day:02}-{EDF_MONTHS[date.month - 1]}-{date.year:04}"
+
+def _edf_tal(onset, duration=None, description=""):
+    """Encode one time-stamped annotation list entry.
+
+    Onset and duration aren't header fields, so they are written with full
+    precision (shortest round-tripping decimal, as edfio does).
+    """
+    text = np.format_float_positional(onset, unique=True, trim="-", sign=True)
+    if duration is not None:
+        text += "\x15" + np.format_float_positional(duration, unique=True, trim="-")
+    return f"{text}\x14{description}\x14\x00".encode("utf-8")
+
+def _edf_patient(subject_info):
+    """Local patient identification field, from ``raw.info["subject_info"]``."""
+    if subject_info is None:
+        return "X X X X"
+    name = "_".join(filter(None, [subject_info.get(k, "") for k in ["first_name", "middle_name", "last_name"]]))
+    additional = [f"{k}={subject_info[k]}" for k in ["height", "weight", "hand"] if subject_info.get(k)]
+    return " ".join([
+        subject_info.get("his_id") or "X",
+        {1: "M", 2: "F"}.get(subject_info.get("sex"), "X"),
+        _edf_date(subject_info.get("birthday")),
+        name or "X",
+        *additional,
+    ])
+
+def write_edf(raw, filepath, record_duration=1, block_records=3600):
+    """Write a preloaded Raw as EDF+ in large contiguous blocks.
+
+    Physical/digital scaling of every channel is computed in one vectorized
+    pass and the data records (plus the EDF+ timekeeping annotations) are
+    assembled as byte arrays and written ``block_records`` at a time. The
+    file is byte-identical to ``mne.export.export_raw`` (see
+    :func:`compare_edf` and check-edf.py).
+
+    Parameters
+    ----------
+    raw : mne.io.Raw
+        Preloaded recording with an integer number of samples per record.
+    filepath : str or Path
+        Output ``.edf`` path (overwritten).
+    record_duration : int
+        Duration (in seconds) of one data record.
+    block_records : int
+        Number of data records to assemble per write.
+    """
+    sfreq = raw.info["sfreq"]
+    samples_per_record = sfreq * record_duration
+    if not float(samples_per_record).is_integer():
+        raise ValueError("Sampling frequency must give an integer number of samples per record")
+    samples_per_record = int(samples_per_record)
+
+    ch_types = np.array(raw.get_channel_types())
+    is_uv = np.isin(ch_types, EDF_UV_TYPES)
+    data = raw.get_data()
+    data *= np.where(is_uv, 1e6, 1.0)[:, np.newaxis]
+    n_channels, n_times = data.shape
+
+    # Physical range shared within each channel type.
+    phys_min = np.empty(n_channels)
+    phys_max = np.empty(n_channels)
+    for ch_type in np.unique(ch_types):
+        mask = ch_types == ch_type
+        phys_min[mask] = data[mask].min()
+        phys_max[mask] = data[mask].max()
+    phys_max = np.where(phys_max == phys_min, phys_min + 1, phys_max)
+
+    # Pad the last record with edge values, as MNE does.
+    n_records = int(np.ceil(n_times / samples_per_record))
+    pad_width = n_records * samples_per_record - n_times
+    # Channel-specific annotations get one entry per channel ("description@@channel").
+    annotations = []
+    for onset, duration, description, ch_names in zip(raw.annotations.onset, raw.annotations.duration,
+            raw.annotations.description, raw.annotations.ch_names):
+        for suffix in [f"@@{ch}" for ch in ch_names] or [""]:
+            annotations.append((onset - raw.first_time, duration, description + suffix))
+    if pad_width > 0:
+        data = np.pad(data, ((0, 0), (0, pad_width)), mode="edge")
+        annotations.append((raw.times[-1] + 1 / sfreq, pad_width / sfreq, "BAD_ACQ_SKIP"))
+
+    # Bounds are widened outward to fit the header so the extreme samples
+    # aren't clipped, and used as they will read back from it.
+    phys_min_str = [_edf_bound(x, upper=False) for x in phys_min]
+    phys_max_str = [_edf_bound(x, upper=True) for x in phys_max]
+    phys_min = np.array(phys_min_str, dtype=float)
+    phys_max = np.array(phys_max_str, dtype=float)
+    dig_min, dig_max = EDF_DIGITAL_RANGE
+    gain = (phys_max - phys_min) / (dig_max - dig_min)
+    offset = phys_max / gain - dig_max
+    digital = np.round(data / gain[:, np.newaxis] - offset[:, np.newaxis])
+    digital = np.clip(digital, dig_min, dig_max).astype("<i2")
+    del data
+
+    # EDF+ annotation signal: a timekeeping entry per record, followed by the
+    # annotations starting within that record (the last record takes the rest).
+    # Onsets are relative to the start second, as the header time has no fraction.
+    meas_date = raw.info["meas_date"]
+    subsecond = 0 if meas_date is None else meas_date.microsecond / 1e6
+    annotations = sorted(annotations, reverse=True)
+    tals = []
+    for i, start in enumerate(np.arange(n_records) * record_duration):
+        tal = _edf_tal(start + subsecond, description="")
+        while annotations and (annotations[-1][0] < start + record_duration or i == n_records - 1):
+            onset, duration, description = annotations.pop()
+            tal += _edf_tal(onset + subsecond, duration, description)
+        tals.append(tal)
+    annotation_samples = int(np.ceil(max(len(t) for t in tals) / 2))
+    annotation_bytes = np.zeros((n_records, annotation_samples * 2), dtype=np.uint8)
+    for i, tal in enumerate(tals):
+        annotation_bytes[i, :len(tal)] = np.frombuffer(tal, dtype=np.uint8)
+
+    # Header.
+    prefiltering = f"HP:{raw.info['highpass']}Hz LP:{raw.info['lowpass']}Hz"
+    if raw.info["line_freq"] is not None:
+        prefiltering += f" N:{raw.info['line_freq']}Hz"
+    device_info = raw.info.get("device_info")
+    equipment = "X" if device_info is None else (device_info.get("type") or "X")
+    startdate = None if meas_date is None else meas_date.date()
+    n_signals = n_channels + 1
+    header = b"".join([
+        _edf_field("0", 8),
+        _edf_field(_edf_patient(raw.info.get("subject_info")), 80),
+        _edf_field(f"Startdate {_edf_date(startdate)} X X {equipment}", 80),
+        _edf_field("01.01.85" if meas_date is None else meas_date.strftime("%d.%m.%y"), 8),
+        _edf_field("00.00.00" if meas_date is None else meas_date.strftime("%H.%M.%S"), 8),
+        _edf_field(256 * (n_signals + 1), 8),
+        _edf_field("EDF+C", 44),
+        _edf_field(n_records, 8),
+        _edf_field(_edf_number(record_duration), 8),
+        _edf_field(n_signals, 4),
+    ])
+    labels = raw.ch_names + [EDF_ANNOTATIONS_LABEL]
+    units = ["uV" if uv else "" for uv in is_uv]
+    signal_fields = [
+        [_edf_field(label, 16) for label in labels],
+        [_edf_field("", 80) for _ in labels],
+        [_edf_field(unit, 8) for unit in units] + [_edf_field("", 8)],
+        [_edf_field(x, 8) for x in phys_min_str] + [_edf_field(-32768, 8)],
+        [_edf_field(x, 8) for x in phys_max_str] + [_edf_field(32767, 8)],
+        [_edf_field(dig_min, 8) for _ in raw.ch_names] + [_edf_field(-32768, 8)],
+        [_edf_field(dig_max, 8) for _ in raw.ch_names] + [_edf_field(32767, 8)],
+        [_edf_field(prefiltering, 80) for _ in raw.ch_names] + [_edf_field("", 80)],
+        [_edf_field(samples_per_record, 8) for _ in raw.ch_names] + [_edf_field(annotation_samples, 8)],
+        [_edf_field("", 32) for _ in labels],
+    ]
+    header += b"".join(b"".join(field) for field in signal_fields)
+
+    # Data records: (n_records, n_channels * samples_per_record) int16 bytes
+    # followed by the annotation bytes of each record.
+    digital = digital.reshape(n_channels, n_records, samples_per_record).transpose(1, 0, 2)
+    with open(filepath, "wb") as fp:
+        fp.write(header)
+        for start in range(0, n_records, block_records):
+            stop = min(start + block_records, n_records)
+            signal_bytes = np.ascontiguousarray(digital[start:stop]).reshape(stop - start, -1).view(np.uint8)
+            fp.write(np.concatenate([signal_bytes, annotation_bytes[start:stop]], axis=1).tobytes())
+
+def compare_edf(raw, filepath):
+    """Compare an EDF written by :func:`write_edf` against ``mne.export.export_raw``.
+
+    Exports ``raw`` with MNE to a temporary file and checks the two files
+    byte for byte. Returns the offset of the first differing byte, or
+    None when the files are identical.
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        reference_path = Path(tmp_dir) / Path(filepath).name
+        mne.export.export_raw(reference_path, raw, add_ch_type=False, overwrite=True)
+        reference = np.fromfile(reference_path, dtype=np.uint8)
+    written = np.fromfile(filepath, dtype=np.uint8)
+    n_bytes = min(reference.size, written.size)
+    mismatch = np.flatnonzero(reference[:n_bytes] != written[:n_bytes])
+    if mismatch.size:
+        return int(mismatch[0])
+    if reference.size != written.size:
+        return n_bytes
+    return None
@@ -2,13 +2,13 @@
 import argparse
 from pathlib import Path
 
-from bids import BIDSLayout
 import mne
 import neurokit2 as nk
 import numpy as np
 import pandas as pd
 import tqdm
 
+import psg
 import utils
 
 mne.set_log_level(verbose=utils.MNE_VERBOSITY)
@@ -24,7 +24,7 @@ participant = args.participant
 resp_channel = "Fz"
 
 
-layout = BIDSLayout(utils.ROOT_DIR, validate=False)
+layout = utils.get_layout()
 # stimuli_dir = bids_root / "stimuli"
 bids_files = layout.get(
     subject=f"{participant:03d}",
@@ -41,8 +41,8 @@ bids_files = layout.get(
 
 bf = bids_files[0]
 
-# Load raw data.
-raw = mne.io.read_raw_edf(bf.path)
+# Load raw data (from the memory-mapped store if there is one).
+raw = psg.read_raw(bf.path, picks=[resp_channel])
 
 # Extract sampling frequency (for convenience).
 sfreq = raw.info["sfreq"]
@@ -51,7 +51,7 @@ sfreq = raw.info["sfreq"]
 events_path = bf.path.replace("eeg.edf", "events.tsv")
 # if not Path(events_path).exists():
 #     continue
-events = pd.read_csv(events_path, sep="\t")
+events = utils.read_tsv(events_path)
 # # events = mne.read_events(bf.path.replace("eeg.edf", "events.tsv"))
 # # mne.pick_events()
 # if "Cue" not in events["description"]:
@@ -1,8 +1,18 @@
+import argparse
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+import hashlib
+import importlib
+import json
+from pathlib import Path
 import subprocess
 import sys
+import threading
+import traceback
 
 from tqdm import tqdm
 
+import utils
+
 
 def run_command(command):
     """Run shell command and exit upon failure."""
@@ -10,37 +20,341 @@ def run_command(command):
     if result.returncode != 0:
         sys.exit()
 
+def corrections_changed(participant):
+    """True if a participant's corrections differ from the ones their exports were made with."""
+    participant_id = f"sub-{participant:03d}"
+    applied_path = utils.DERIVATIVES_DIR / participant_id / f"{participant_id}_corrections.json"
+    if not applied_path.exists():
+        return True
+    return utils.import_json(applied_path)["digest"] != utils.corrections_digest(participant_id)
+
+
+################################################################################
+# INCREMENTAL BUILD
+################################################################################
+
+
+# What each participant script reads and writes, as glob patterns relative to
+# the BIDS root ({participant_id} is filled in). Code is relative to this directory.
+# Steps with "corrections" also depend on the participant's corrections.json entry.
+# "depends" are the steps of the same participant that must finish first, and
+# "memory" is a rough peak memory use (GB) for the parallel scheduler.
+CODE_DIR = Path(__file__).parent
+SHARED_CODE = ["utils.py", "psg.py"]
+STEPS = {
+    "source2raw-eeg": {
+        "inputs": [
+            "participants.tsv",
+            "sourcedata/{participant_id}/{participant_id}_ses-*_eeg.cnt",
+            "sourcedata/{participant_id}/{participant_id}_ses-*_tmr.log",
+            "sourcedata/{participant_id}/*task*_portcodes.json",
+        ],
+        "code": ["source2raw-eeg.py"],
+        "depends": [],
+        "memory": 8,
+        "corrections": True,
+        "outputs": ["{participant_id}/eeg/{participant_id}_task-*_eeg.edf"],
+    },
+    "calc-hypno": {
+        "inputs": [
+            "phenotype/initial_survey.tsv",
+            "{participant_id}/eeg/{participant_id}_task-sleep_*_eeg.edf",
+            "derivatives/{participant_id}/{participant_id}_task-sleep_*_eeg.*",
+        ],
+        "code": ["calc-hypno.py", "staging.py", "hypnogram.py"],
+        "depends": ["source2raw-eeg"],
+        "memory": 4,
+        "outputs": ["derivatives/{participant_id}/{participant_id}_task-sleep_*_hypno.tsv"],
+    },
+    "plot-hypno": {
+        "inputs": [
+            "{participant_id}/eeg/{participant_id}_task-sleep_*_events.tsv",
+            "derivatives/{participant_id}/{participant_id}_task-sleep_*_hypno.tsv",
+        ],
+        "code": ["plot-hypno.py", "hypnogram.py"],
+        "depends": ["calc-hypno"],
+        "memory": 1,
+        "outputs": ["derivatives/{participant_id}/{participant_id}_task-sleep_*_hypno.png"],
+    },
+    "calc-resp": {
+        "inputs": [
+            "{participant_id}/eeg/{participant_id}_task-sleep_*_eeg.edf",
+            "{participant_id}/eeg/{participant_id}_task-sleep_*_events.tsv",
+            "derivatives/{participant_id}/{participant_id}_task-sleep_*_eeg.*",
+        ],
+        "code": ["calc-resp.py"],
+        "depends": ["source2raw-eeg"],
+        "memory": 2,
+        "outputs": [
+            "derivatives/{participant_id}/{participant_id}_task-sleep_*_resp.tsv",
+            "derivatives/{participant_id}/{participant_id}_task-sleep_*_rrv.tsv",
+        ],
+    },
+    "plot-resp_hypno": {
+        "inputs": [
+            "{participant_id}/eeg/{participant_id}_task-sleep_*_events.tsv",
+            "derivatives/{participant_id}/{participant_id}_task-sleep_*_hypno.tsv",
+            "derivatives/{participant_id}/{participant_id}_task-sleep_*_resp.tsv",
+        ],
+        "code": ["plot-resp_hypno.py", "hypnogram.py"],
+        "depends": ["calc-hypno", "calc-resp"],
+        "memory": 1,
+        "outputs": ["derivatives/{participant_id}/{participant_id}_task-sleep_*_resp.png"],
+    },
+}
+STATE_FILE = utils.DERIVATIVES_DIR / ".runall" / "state.json"
+
+# Group scripts run once, after the group scripts in "depends" and the
+# participant steps in "participant_depends" (for all participants) are done.
+GROUP_STEPS = {
+    "source2raw-wav": {"depends": [], "participant_depends": [], "memory": 2},
+    "source2raw-bct": {"depends": [], "participant_depends": [], "memory": 1},
+    "plot-bct": {"depends": ["source2raw-bct"], "participant_depends": [], "memory": 1},
+    "calc-cues": {"depends": [], "participant_depends": ["calc-hypno"], "memory": 1, "args": "--all"},
+}
+
+
+def expand(pattern, participant_id):
+    """Files matching a STEPS glob pattern for one participant."""
+    return sorted(utils.ROOT_DIR.glob(pattern.format(participant_id=participant_id)))
+
+
+class BuildState:
+    """File hashes (cached by mtime/size) and the input digest of each completed step.
+
+    Digests are computed from the scheduler's worker threads while the main
+    thread saves, so ``files`` and ``steps`` are only touched under a lock.
+    """
+
+    def __init__(self, filepath=STATE_FILE):
+        self.filepath = filepath
+        state = utils.import_json(filepath) if filepath.exists() else {}
+        self.files = state.get("files", {})
+        self.steps = state.get("steps", {})
+        self.lock = threading.Lock()
+
+    def save(self):
+        with self.lock:
+            state = {"files": dict(self.files), "steps": dict(self.steps)}
+        self.filepath.parent.mkdir(parents=True, exist_ok=True)
+        utils.export_json(state, self.filepath)
+
+    def file_hash(self, filepath):
+        """Content hash of a file, only rehashed when its mtime or size changed."""
+        key = filepath.as_posix()
+        signature = utils.file_signature(filepath)
+        with self.lock:
+            cached = self.files.get(key)
+        if cached is None or cached["signature"] != signature:
+            sha = hashlib.sha256()
+            with open(filepath, "rb") as fp:
+                for chunk in iter(lambda: fp.read(1 << 20), b""):
+                    sha.update(chunk)
+            cached = {"signature": signature, "sha256": sha.hexdigest()}
+            with self.lock:
+                self.files[key] = cached
+        return cached["sha256"]
+
+    def step_digest(self, script, participant_id):
+        """Hash of everything a step reads: its input files and its code."""
+        step = STEPS[script]
+        inputs = {p for pattern in step["inputs"] for p in expand(pattern, participant_id)}
+        # A step's own outputs can match its input patterns, they don't count.
+        outputs = {p for pattern in step["outputs"] for p in expand(pattern, participant_id)}
+        code = [CODE_DIR / f for f in SHARED_CODE + step["code"]]
+        listing = [(p.name, self.file_hash(p)) for p in sorted(inputs - outputs) + code]
+        if step.get("corrections"):
+            listing.append(("corrections", utils.corrections_digest(participant_id)))
+        return hashlib.sha256(json.dumps(listing).encode("utf-8")).hexdigest()
+
+    def is_current(self, script, participant_id, digest):
+        """True if the step last succeeded with these inputs and its outputs are still there."""
+        outputs = [p for pattern in STEPS[script]["outputs"] for p in expand(pattern, participant_id)]
+        with self.lock:
+            last_digest = self.steps.get(f"{participant_id}/{script}")
+        return last_digest == digest and len(outputs) > 0
+
+    def mark_done(self, script, participant_id, digest):
+        with self.lock:
+            self.steps[f"{participant_id}/{script}"] = digest
+
+
+################################################################################
+# IN-PROCESS EXECUTION
+################################################################################
+
+
+def import_heavy_modules():
+    """Worker initializer, pays the import cost of the analysis libraries once per worker."""
+    import matplotlib
+    matplotlib.use("Agg")
+    for name in ["mne", "yasa", "neurokit2", "bids", "matplotlib.pyplot"]:
+        importlib.import_module(name)
+
+def run_in_process(script, participant):
+    """Call a participant script's ``run(participant)`` and return an exit code."""
+    try:
+        importlib.import_module(script).run(participant)
+    except Exception:
+        traceback.print_exc()
+        return 1
+    return 0
+
+
+def run_dag(participants, scripts, group_scripts=(), jobs=1, memory=None, incremental=False, in_process=False):
+    """Run the participant x script graph (then group scripts) on a worker pool.
+
+    A step starts once the steps it depends on succeeded, as long as fewer
+    than ``jobs`` steps are running and their summed ``memory`` estimate
+    stays within ``memory`` GB (a step always starts if nothing else is
+    running). With ``incremental``, steps whose inputs and code are
+    unchanged since their last success are skipped. With ``in_process``,
+    participant steps call the script's ``run`` inside long-lived worker
+    processes instead of starting a new interpreter. A failing step skips
+    everything downstream of it. Returns the failed (participant, script) pairs.
+    """
+    state = BuildState() if incremental else None
+    workers = ProcessPoolExecutor(max_workers=jobs, initializer=import_heavy_modules) if in_process else None
+    nodes = {}
+    for p in participants:
+        participant_id = f"sub-{p:03d}"
+        for script in scripts:
+            depends = [(participant_id, d) for d in STEPS[script]["depends"] if d in scripts]
+            nodes[(participant_id, script)] = (f"python {script}.py --participant {p}", depends, STEPS[script]["memory"])
+    for script in group_scripts:
+        step = GROUP_STEPS[script]
+        depends = [(None, d) for d in step["depends"] if d in group_scripts]
+        depends += [n for n in nodes if n[1] in step["participant_depends"]]
+        command = f"python {script}.py {step.get('args', '')}".strip()
+        nodes[(None, script)] = (command, depends, step["memory"])
+
+    def run_node(node):
+        command = nodes[node][0]
+        participant_id, script = node
+        digest = None
+        if state is not None and participant_id is not None:
+            # Computed right before running, so it sees fresh outputs of upstream steps.
+            digest = state.step_digest(script, participant_id)
+            if state.is_current(script, participant_id, digest):
+                return 0, None
+        if workers is not None and participant_id is not None:
+            return workers.submit(run_in_process, script, int(participant_id[4:])).result(), digest
+        return subprocess.run(command, shell=True).returncode, digest
+
+    pending = dict(nodes)
+    done, failures = set(), []
+    running = {}
+    memory_used = 0
+    with tqdm(total=len(nodes), desc="Steps") as pbar, ThreadPoolExecutor(max_workers=jobs) as executor:
+        while pending or running:
+            # Drop nodes downstream of a failure.
+            for node in [n for n, (_, deps, _) in pending.items() if any(d in failures for d in deps)]:
+                failures.append(node)
+                del pending[node]
+                pbar.update()
+            ready = [n for n, (_, deps, _) in pending.items() if all(d in done for d in deps)]
+            for node in ready:
+                node_memory = pending[node][2]
+                if len(running) >= jobs:
+                    break
+                if running and memory is not None and memory_used + node_memory > memory:
+                    continue
+                running[executor.submit(run_node, node)] = node
+                memory_used += node_memory
+                del pending[node]
+            if not running:
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                node = running.pop(future)
+                memory_used -= nodes[node][2]
+                returncode, digest = future.result()
+                if returncode == 0:
+                    done.add(node)
+                    if digest is not None:
+                        state.mark_done(node[1], node[0], digest)
+                        state.save()
+                else:
+                    failures.append(node)
+                pbar.update()
+    if workers is not None:
+        workers.shutdown()
+    if state is not None:
+        state.save()
+    # Only report the steps that actually ran and failed.
+    return [n for n in failures if all(d not in failures for d in nodes[n][1])]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--changed-corrections",
+        action="store_true",
+        help="only rerun participants whose entry in corrections.json changed since their last export",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="skip steps whose input files and code are unchanged since they last succeeded",
+    )
+    parser.add_argument("--jobs", type=int, default=1, help="number of steps to run in parallel")
+    parser.add_argument("--memory", type=float, default=None, help="memory budget (GB) for steps running in parallel")
+    parser.add_argument("--in-process", action="store_true", help="run participant scripts inside persistent worker processes")
+    parser.add_argument("--group", action="store_true", help="also run the group scripts once their inputs are done")
+    args = parser.parse_args()
+
+    participants = [1, 2, 3, 4, 5, 907, 908, 909]
+    if args.changed_corrections:
+        participants = [p for p in participants if corrections_changed(p)]
+    participant_scripts = [
+        "source2raw-eeg",  # Convert EEG file to separate BIDS-formatted edf (and associated) files.
+        "calc-hypno",  # Calculate overnight and nap hypnograms.
+        "plot-hypno",  # Plot overnight and night hypnograms.
+        "calc-resp",  # Calculate respiration features/timecourses.
+        "plot-resp_hypno"  # Plot respiration rate aligned with hypnogram.
+    ]
+    # Group steps built from participant derivatives, always run after the participant steps.
+    derived_group_scripts = [
+        "calc-cues",  # Calculate number of cues per sleep stage, for all participants in one pass.
+    ]
+    group_scripts = [
+        "source2raw-wav",  # Move dream reports wav recordings to raw, and convert to text.
+        "source2raw-bct",  # Convert Breath-Counting Task behavior json/log files to tsv files.
+        "plot-bct",  
+    # Compare group pre-nap and post-nap BCT performance.
+    ]
+
+    if args.incremental or args.jobs > 1 or args.group or args.in_process:
+        failures = run_dag(
+            participants,
+            participant_scripts,
+            derived_group_scripts + (group_scripts if args.group else []),
+            jobs=args.jobs,
+            memory=args.memory,
+            incremental=args.incremental,
+            in_process=args.in_process,
+        )
+        if failures:
+            sys.exit("Failed steps: " + ", ".join(f"{p or 'group'} {s}" for p, s in failures))
+    else:
+        for p in tqdm(participants, desc="Participants"):
+            for script in (pbar := tqdm(participant_scripts, leave=False)):
+                pbar.set_description(script)
+                command = f"python {script}.py --participant {p}"
+                run_command(command)
+        for script in derived_group_scripts:
+            command = f"python {script}.py {GROUP_STEPS[script]['args']}"
+            run_command(command)
+
+    for survey in (
+        "Initial+Survey",
+        "Debriefing+Survey",
+        "Dream+Report",
+        "sub-004+Followup",
+        ):
+        command = f"python source2raw-qualtrics.py --survey {survey}"
+        # run_command(command)
 
-participants = [1, 2, 3, 4, 5, 907, 908, 909]
-participant_scripts = [
-    "source2raw-eeg",  # Convert EEG file to separate BIDS-formatted edf (and associated) files.
-    "calc-hypno",  # Calculate overnight and nap hypnograms.
-    "plot-hypno",  # Plot overnight and night hypnograms.
-    "calc-cues",  # Calculate number of cues per sleep stage.
-    "calc-resp",  # Calculate respiration features/timecourses.
-    "plot-resp_hypno"  # Plot respiration rate aligned with hypnogram.
-]
-for p in tqdm(participants, desc="Participants"):
-    for script in (pbar := tqdm(participant_scripts, leave=False)):
-        pbar.set_description(script)
-        command = f"python {script}.py --participant {p}"
-        run_command(command)
-
-for survey in (
-    "Initial+Survey",
-    "Debriefing+Survey",
-    "Dream+Report",
-    "sub-004+Followup",
-    ):
-    command = f"python source2raw-qualtrics.py --survey {survey}"
-    # run_command(command)
-
-group_scripts = [
-    "source2raw-wav",  # Move dream reports wav recordings to raw, and convert to text.
-    "source2raw-bct",  # Convert Breath-Counting Task behavior json/log files to tsv files.
-    "plot-bct",  
-# Compare group pre-nap and post-nap BCT performance.
-]
-for script in group_scripts:
-    command = f"python {script}.py"
-    # run_command(command)
+    for script in group_scripts:
+        command = f"python {script}.py"
+        # run_command(command)
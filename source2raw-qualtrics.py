@@ -164,6 +164,9 @@ if survey_name == "Dream+Report":
 
         utils.export_tsv(awakenings, export_path, index=False)
         utils.export_json(sidecar, export_path.with_suffix(".json"))
+        # Make sure the file reads back through the rep schema.
+        reread = utils.read_tsv(export_path, suffix="rep", cache=False)
+        assert reread["awakening_id"].tolist() == awakenings["awakening_id"].tolist(), "rep file doesn't round-trip"
 else:
     export_name = survey_name.lower().replace("+", "_") + ".tsv"
     export_path = phenotype_dir / export_name
@@ -0,0 +1,284 @@
+"""Sleep staging helpers (YASA features and classifiers) used by calc-hypno."""
+
+from fractions import Fraction
+from functools import lru_cache
+import hashlib
+from pathlib import Path
+
+import antropy as ant
+import joblib
+import mne
+import numpy as np
+import pandas as pd
+from scipy import integrate, signal, stats
+import yasa
+
+import psg
+import utils
+
+
+CLASSIFIER_DIR = Path(yasa.__file__).parent / "classifiers"
+FEATURE_CACHE_DIR = utils.DERIVATIVES_DIR / ".cache" / "staging"
+FEATURE_VERSION = f"1-yasa{yasa.__version__}"  # Bump the leading number when get_features output changes.
+
+# YASA's staging preprocessing and spectral bands (see yasa.SleepStaging).
+EPOCH_LENGTH = utils.EPOCH_LENGTH
+STAGING_SFREQ = 100
+STAGING_FREQS = (0.4, 30)
+STAGING_BANDS = [
+    (0.4, 1, "sdelta"),
+    (1, 4, "fdelta"),
+    (4, 8, "theta"),
+    (8, 12, "alpha"),
+    (12, 16, "sigma"),
+    (16, 30, "beta"),
+]
+
+
+def model_path(eog=True, emg=True, demo=False):
+    """Path of the YASA classifier trained on these inputs (same choice as ``SleepStaging.predict``)."""
+    name = "clf_eeg"
+    name += "+eog" if eog else ""
+    name += "+emg" if emg else ""
+    name += "+demo" if demo else ""
+    matches = sorted(CLASSIFIER_DIR.glob(f"{name}_*.joblib"))
+    assert matches, f"No YASA classifier found for {name}"
+    return matches[-1]
+
+@lru_cache
+def load_model(path):
+    """Load a classifier once per process."""
+    return joblib.load(path)
+
+def extract_features(raw, eeg_name, eog_name=None, emg_name=None, metadata=None):
+    """Per-epoch YASA feature matrix of one recording, and the classifier it needs."""
+    sls = yasa.SleepStaging(raw,
+        eeg_name=eeg_name,
+        eog_name=eog_name,
+        emg_name=emg_name,
+        metadata=metadata,
+    )
+    model = model_path(eog=eog_name is not None, emg=emg_name is not None, demo=metadata is not None)
+    return sls.get_features(), model
+
+def file_hash(filepath, chunk_size=2**24):
+    """sha256 of a file's content, remembered per mtime/size so a file is only hashed once."""
+    filepath = Path(filepath)
+    memo_path = FEATURE_CACHE_DIR / "hashes" / f"{filepath.name}_{utils.file_signature(filepath)}.pkl"
+    digest = utils.import_pickle(memo_path)
+    if digest is not None:
+        return digest
+    sha = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        while chunk := f.read(chunk_size):
+            sha.update(chunk)
+    digest = sha.hexdigest()
+    utils.export_pickle(digest, memo_path)
+    return digest
+
+def cached_features(filepath, eeg_name, eog_name=None, emg_name=None, metadata=None, cache=True):
+    """Same as :func:`extract_features` but from a file path, through a feature cache.
+
+    The demographic-free feature matrix is pickled under ``FEATURE_CACHE_DIR``,
+    keyed by the source file's content hash, the channel triplet and
+    ``FEATURE_VERSION``. YASA only appends the metadata as constant columns,
+    so those are added after the cache and changing demographics reuses it.
+    The raw data is only read on a cache miss.
+    """
+    channels = [eeg_name, eog_name, emg_name]
+    key = "|".join([file_hash(filepath), *map(str, channels), FEATURE_VERSION])
+    key = hashlib.sha1(key.encode("utf-8")).hexdigest()
+    cache_path = FEATURE_CACHE_DIR / f"{Path(filepath).stem}_{key}.pkl"
+    features = utils.import_pickle(cache_path) if cache else None
+    if features is None:
+        raw = psg.read_raw(filepath, picks=[ch for ch in channels if ch is not None])
+        features, _ = extract_features(raw, eeg_name, eog_name, emg_name)
+        if cache:
+            utils.export_pickle(features, cache_path)
+    if metadata is not None:
+        features = features.assign(**metadata)
+    model = model_path(eog=eog_name is not None, emg=emg_name is not None, demo=metadata is not None)
+    return features, model
+
+def predict(features, model):
+    """Stage several recordings with a single classifier call.
+
+    Parameters
+    ----------
+    features : list of pandas.DataFrame
+        Feature matrices (from :func:`extract_features`) that all use ``model``.
+    model : str or Path
+        Classifier path.
+
+    Returns
+    -------
+    results : list of (numpy.ndarray, pandas.DataFrame)
+        Per recording, the predicted stage labels and the stage
+        probabilities (indexed by ``epoch``), as from ``SleepStaging``.
+    """
+    clf = load_model(model)
+    X = pd.concat(features, ignore_index=True)[clf.feature_name_]
+    proba = clf.predict_proba(X)
+    # Same as clf.predict, without running the trees twice.
+    labels = clf.classes_[proba.argmax(axis=1)]
+    splits = np.cumsum([len(f) for f in features])[:-1]
+    results = []
+    for labels_, proba_ in zip(np.split(labels, splits), np.split(proba, splits)):
+        proba_ = pd.DataFrame(proba_, columns=clf.classes_).rename_axis("epoch")
+        results.append((labels_, proba_))
+    return results
+
+
+def _open_lazy(edf_path, channels):
+    """Block reader over a recording that doesn't load it, plus its sfreq and length.
+
+    Reads from the memory-mapped sample store when source2raw-eeg.py wrote
+    one (and it isn't older than the EDF), otherwise from the EDF.
+    ``read(start, stop)`` returns µV.
+    """
+    store_path = psg.fresh_store(edf_path, ".npy")
+    if store_path is not None:
+        data, header = psg.open_samples(store_path)
+        rows = [header["ch_names"].index(ch) for ch in channels]
+        read = lambda start, stop: data[rows, start:stop] * 1e6
+        return read, header["sfreq"], header["n_times"]
+    raw = mne.io.read_raw_edf(edf_path, preload=False)
+    read = lambda start, stop: raw.get_data(picks=channels, start=start, stop=stop) * 1e6
+    return read, raw.info["sfreq"], raw.n_times
+
+def iter_epochs(read, sfreq, n_times, channels, block_duration=600):
+    """Yield consecutive 30-s epochs, block by block, preprocessed for staging.
+
+    Each block is read with an epoch of padding on both sides, downsampled
+    to ``STAGING_SFREQ`` and band-passed (``STAGING_FREQS``), and only its
+    unpadded middle is kept, so memory doesn't grow with recording length.
+    Samples left over after the last whole epoch of a block are carried
+    into the next one. Yields ``(n_channels, n_epochs, n_samples)`` arrays.
+    """
+    ratio = Fraction(STAGING_SFREQ / sfreq).limit_denominator(1000)
+    up, down = ratio.numerator, ratio.denominator
+    bank = psg.FilterBank(cutoffs={"staging": STAGING_FREQS}, picks={"staging": channels}, filter_params={})
+    ch_types = ["eeg"] * len(channels)
+    # Keep block edges on multiples of the decimation factor so output samples stay aligned.
+    pad = int(np.ceil(EPOCH_LENGTH * sfreq / down) * down)
+    block_size = int(np.ceil(block_duration * sfreq / down) * down)
+    epoch_size = EPOCH_LENGTH * STAGING_SFREQ
+    carry = np.empty((len(channels), 0))
+    for start in range(0, n_times, block_size):
+        stop = min(start + block_size, n_times)
+        read_start = max(start - pad, 0)
+        read_stop = min(stop + pad, n_times)
+        data = signal.resample_poly(read(read_start, read_stop), up, down, axis=-1)
+        data = bank.apply(data, STAGING_SFREQ, channels, ch_types)
+        offset = (start - read_start) * up // down
+        n_out = (stop - start) * up // down
+        data = np.concatenate([carry, data[:, offset:offset + n_out]], axis=1)
+        n_epochs = data.shape[1] // epoch_size
+        carry = data[:, n_epochs * epoch_size:]
+        if n_epochs:
+            yield data[:, :n_epochs * epoch_size].reshape(len(channels), n_epochs, epoch_size)
+
+def epoch_features(epochs, ch_type):
+    """YASA's per-epoch features of one channel, before smoothing.
+
+    ``epochs`` is ``(n_epochs, n_samples)`` in µV at ``STAGING_SFREQ``, and
+    ``ch_type`` is "eeg", "eog" or "emg" (it sets the feature prefix and
+    which spectral features are computed).
+    """
+    sf = STAGING_SFREQ
+    hmob, hcomp = ant.hjorth_params(epochs, axis=1)
+    feat = {
+        "std": np.std(epochs, ddof=1, axis=1),
+        "iqr": stats.iqr(epochs, rng=(25, 75), axis=1),
+        "skew": stats.skew(epochs, axis=1),
+        "kurt": stats.kurtosis(epochs, axis=1),
+        "nzc": ant.num_zerocross(epochs, axis=1),
+        "hmob": hmob,
+        "hcomp": hcomp,
+    }
+    freqs, psd = signal.welch(epochs, sf, window="hamming", nperseg=int(2 / STAGING_FREQS[0] * sf), average="median")
+    if ch_type != "emg":
+        bp = yasa.bandpower_from_psd_ndarray(psd, freqs, bands=STAGING_BANDS)
+        for j, (_, _, band) in enumerate(STAGING_BANDS):
+            feat[band] = bp[j]
+    if ch_type == "eeg":
+        delta = feat["sdelta"] + feat["fdelta"]
+        feat["dt"] = delta / feat["theta"]
+        feat["ds"] = delta / feat["sigma"]
+        feat["db"] = delta / feat["beta"]
+        feat["at"] = feat["alpha"] / feat["theta"]
+    idx_broad = (freqs >= STAGING_FREQS[0]) & (freqs <= STAGING_FREQS[1])
+    feat["abspow"] = integrate.trapezoid(psd[:, idx_broad], dx=freqs[1] - freqs[0])
+    feat["perm"] = np.apply_along_axis(ant.perm_entropy, axis=1, arr=epochs, normalize=True)
+    feat["higuchi"] = np.apply_along_axis(ant.higuchi_fd, axis=1, arr=epochs)
+    feat["petrosian"] = ant.petrosian_fd(epochs, axis=1)
+    return pd.DataFrame(feat).add_prefix(f"{ch_type}_")
+
+def _robust_scale(df):
+    """Center on the median and scale by the 5-95 percentile range, per column."""
+    q05, median, q95 = (df.quantile(q) for q in (0.05, 0.5, 0.95))
+    return (df - median) / (q95 - q05).replace(0, 1)
+
+def finish_features(base, n_epochs=None, metadata=None):
+    """Add YASA's smoothed, normalized and temporal features to per-epoch features.
+
+    ``base`` holds the :func:`epoch_features` of every channel for the
+    epochs staged so far. ``n_epochs`` is the length of the whole recording
+    (for ``time_norm``), default ``len(base)``. On a partial recording the
+    centered smoothing and the normalization only see the epochs so far.
+    """
+    n_epochs = len(base) if n_epochs is None else n_epochs
+    # Centered triangular average over 15 epochs (7.5 min) and past 4 epochs (2 min).
+    rollc = base.rolling(window=15, center=True, min_periods=1, win_type="triang").mean()
+    rollp = base.rolling(window=4, min_periods=1).mean()
+    features = base.join(_robust_scale(rollc).add_suffix("_c7min_norm"))
+    features = features.join(_robust_scale(rollp).add_suffix("_p2min_norm"))
+    times = np.arange(len(base)) * EPOCH_LENGTH
+    features["time_hour"] = times / 3600
+    features["time_norm"] = times / max((n_epochs - 1) * EPOCH_LENGTH, 1)
+    features = features.astype(np.float32).rename_axis("epoch")
+    if metadata is not None:
+        features = features.assign(**metadata)
+    return features
+
+def stream_stage(edf_path, eeg_name, eog_name=None, emg_name=None, metadata=None, block_duration=600, callback=None):
+    """Stage a recording block by block, without loading the whole night.
+
+    Only one block of samples (plus padding) is in memory at a time; what
+    accumulates is the small per-epoch feature table. After each block the
+    new epochs are staged with the features available so far and passed
+    to ``callback(labels, proba)`` as a provisional hypnogram. Once the
+    recording is read, the whole night is staged again with the complete
+    smoothing and normalization, as ``SleepStaging`` would.
+
+    Preprocessing uses polyphase resampling and the shared FIR design
+    instead of MNE's FFT resampling, so features differ slightly from
+    :func:`extract_features`.
+
+    Returns
+    -------
+    labels, proba
+        Final stage labels and probabilities (indexed by ``epoch``).
+    """
+    roles = {"eeg": eeg_name, "eog": eog_name, "emg": emg_name}
+    roles = {ch_type: ch for ch_type, ch in roles.items() if ch is not None}
+    channels = list(roles.values())
+    model = model_path(eog=eog_name is not None, emg=emg_name is not None, demo=metadata is not None)
+    read, sfreq, n_times = _open_lazy(edf_path, channels)
+    n_epochs = int(n_times * STAGING_SFREQ / sfreq) // (EPOCH_LENGTH * STAGING_SFREQ)
+
+    blocks = []
+    n_done = 0
+    for epochs in iter_epochs(read, sfreq, n_times, channels, block_duration):
+        blocks.append(pd.concat([epoch_features(epochs[i], ch_type) for i, ch_type in enumerate(roles)], axis=1))
+        if callback is not None:
+            base = pd.concat(blocks, ignore_index=True)
+            features = finish_features(base, n_epochs, metadata)
+            [(labels, proba)] = predict([features.iloc[n_done:]], model)
+            proba.index = pd.RangeIndex(n_done, len(base), name="epoch")
+            callback(labels, proba)
+            n_done = len(base)
+
+    base = pd.concat(blocks, ignore_index=True)
+    [(labels, proba)] = predict([finish_features(base, metadata=metadata)], model)
+    return labels, proba
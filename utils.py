@@ -1,9 +1,16 @@
 """Global parameters and helper functions."""
 
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timezone
+import hashlib
 import json
+import os
 from pathlib import Path
+import pickle
+import re
+import tempfile
 
+from bids import BIDSLayout
 import colorcet as cc
 import matplotlib.pyplot as plt
 import numpy as np
@@ -20,6 +27,7 @@ ROOT_DIR = Path("~/PROJECTS/bct-tmr").expanduser()
 SOURCE_DIR = ROOT_DIR / "sourcedata"
 DERIVATIVES_DIR = ROOT_DIR / "derivatives"
 STIMULI_DIR = ROOT_DIR / "stimuli"
+CORRECTIONS_FILE = Path(__file__).parent / "corrections.json"
 
 # PSG
 EEG_SOURCE_EXTENSION = ".cnt"
@@ -32,9 +40,33 @@ MISC_CHANNELS = ["L-MSTD", "Airflow", "Snoring", "RESP"]
 # REFERENCE_CHANNEL = "R-MSTD"
 # GROUND_CHANNEL = "Fpz"
 NOTCH_FREQUENCY = 60
+RESAMPLE_FREQUENCY = 100
+
+# Bandpass filtering, from AASM guidelines.
+FILTER_PARAMS = dict(filter_length="auto", method="fir", fir_window="hamming")
+FILTER_CUTOFFS = {
+    "eeg": (0.3, 35), # Hz; Low-cut, High-cut
+    "eog": (0.3, 35),
+    "emg": (10, 100),
+    # "ecg": (0.3, 70),
+    "snoring": (10, 100),
+    "respiration": (0.1, 15),
+}
+FILTER_PICKS = {
+    "eeg": "eeg",
+    "eog": "eog",
+    "emg": "emg",
+    # "ecg": "ecg",
+    "snoring": "Snoring",
+    "respiration": ["RESP", "Airflow"],
+}
 
 MNE_VERBOSITY = False
 
+# Sleep staging, in order of YASA's integer codes (W=0 ... R=4).
+SLEEP_STAGES = ["W", "N1", "N2", "N3", "R"]
+EPOCH_LENGTH = 30  # seconds
+
 
 ################################################################################
 # MISCELLANEOUS
@@ -57,6 +89,34 @@ def export_tsv(df, filepath, mkdir=True, **kwargs):
         Path(filepath).parent.mkdir(parents=True, exist_ok=True)
     df.to_csv(filepath, **kwargs)
 
+def export_pickle(obj, filepath, mkdir=True):
+    """Pickle to a temporary file next to ``filepath``, then move it into place.
+
+    The rename is atomic, so processes reading the cache concurrently
+    never see a half-written file.
+    """
+    filepath = Path(filepath)
+    if mkdir:
+        filepath.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=filepath.parent, prefix=f".{filepath.name}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as fp:
+            pickle.dump(obj, fp, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, filepath)
+    except BaseException:
+        Path(tmp_path).unlink(missing_ok=True)
+        raise
+
+def import_pickle(filepath):
+    """Load a cache pickle, or None if it is missing or unreadable (a cache miss)."""
+    try:
+        return pd.read_pickle(filepath)
+    except FileNotFoundError:
+        return None
+    except Exception:
+        # Truncated or otherwise corrupt cache file, it gets rewritten.
+        return None
+
 def export_mpl(filepath, mkdir=True, close=True):
     filepath = Path(filepath)
     if mkdir:
@@ -75,11 +135,342 @@ def load_participants_file():
     return df
 
 
+################################################################################
+# BIDS LAYOUT
+################################################################################
+
+
+LAYOUT_CACHE_DIR = DERIVATIVES_DIR / ".cache" / "bids"
+LAYOUT_IGNORE = ["code", "sourcedata", "stimuli"]
+_layouts = {}
+
+
+def _tree_signature(derivatives):
+    """Hash of the modification time of every directory a layout indexes.
+
+    Adding, removing or renaming a file changes its directory's mtime, so
+    this is enough to tell whether the file index is stale without
+    touching any files.
+    """
+    skip = LAYOUT_IGNORE + ([] if derivatives else ["derivatives"])
+    sha = hashlib.sha256()
+    for dirpath, dirnames, _ in os.walk(ROOT_DIR):
+        if dirpath == str(ROOT_DIR):
+            dirnames[:] = [d for d in dirnames if d not in skip]
+        dirnames[:] = sorted(d for d in dirnames if not d.startswith("."))
+        sha.update(f"{dirpath}:{os.stat(dirpath).st_mtime_ns};".encode("utf-8"))
+    return sha.hexdigest()
+
+def get_layout(derivatives=False, validate=False):
+    """BIDSLayout of the dataset, backed by a persistent index database.
+
+    The index is stored under ``LAYOUT_CACHE_DIR`` (one database for the
+    raw dataset and one including derivatives) and only rebuilt when the
+    directory mtimes of the part of the tree it covers change, so writing
+    derivatives doesn't invalidate the raw index. Layouts are also kept in
+    memory for repeated calls within one process.
+    """
+    name = "derivatives" if derivatives else "raw"
+    if validate:
+        name += "-validated"
+    signature = _tree_signature(derivatives)
+    if name in _layouts and _layouts[name][0] == signature:
+        return _layouts[name][1]
+    database_path = LAYOUT_CACHE_DIR / name
+    signature_path = LAYOUT_CACHE_DIR / f"{name}.signature"
+    reset = not signature_path.exists() or signature_path.read_text() != signature
+    layout = BIDSLayout(
+        ROOT_DIR,
+        derivatives=derivatives,
+        validate=validate,
+        database_path=database_path,
+        reset_database=reset,
+    )
+    if reset:
+        signature_path.write_text(signature)
+    _layouts[name] = (signature, layout)
+    return layout
+
+
+
+################################################################################
+# BIDS PATH RESOLVER
+################################################################################
+
+
+# Filename entities, in BIDS order, and their key in the filename.
+BIDS_ENTITIES = {"subject": "sub", "session": "ses", "task": "task", "acquisition": "acq", "run": "run"}
+BIDS_FILENAME_PATTERN = re.compile(
+    r"^sub-(?P<subject>[a-zA-Z0-9]+)"
+    r"(?:_ses-(?P<session>[a-zA-Z0-9]+))?"
+    r"(?:_task-(?P<task>[a-zA-Z0-9]+))?"
+    r"(?:_acq-(?P<acquisition>[a-zA-Z0-9]+))?"
+    r"(?:_run-(?P<run>[a-zA-Z0-9]+))?"
+    r"_(?P<suffix>[a-zA-Z0-9]+)(?P<extension>\.[^/]+)$"
+)
+BIDS_DATATYPES = ["anat", "beh", "eeg", "func", "rep"]
+
+
+class BIDSPath:
+    """Minimal stand-in for pybids' BIDSFile (``path``, ``entities``, ``get_df``)."""
+
+    def __init__(self, path, entities):
+        self.path = str(path)
+        self.entities = entities
+
+    def __repr__(self):
+        return f"<BIDSPath {self.path}>"
+
+    @property
+    def filename(self):
+        return os.path.basename(self.path)
+
+    @property
+    def dirname(self):
+        return os.path.dirname(self.path)
+
+    def get_df(self, **kwargs):
+        """Load a tsv file with its suffix schema (see :func:`read_tsv`)."""
+        return read_tsv(self.path, suffix=self.entities["suffix"], **kwargs)
+
+def parse_entities(path):
+    """Entities of a BIDS filename (None if it doesn't follow the pattern)."""
+    path = Path(path)
+    match = BIDS_FILENAME_PATTERN.match(path.name)
+    if match is None:
+        return None
+    entities = {k: v for k, v in match.groupdict().items() if v is not None}
+    if path.parent.name in BIDS_DATATYPES:
+        entities["datatype"] = path.parent.name
+    return entities
+
+def build_path(entities, pattern, root=None):
+    """Fill a path pattern from entities, e.g. ``bf.entities`` (like ``BIDSLayout.build_path``)."""
+    root = ROOT_DIR if root is None else Path(root)
+    return str(root / pattern.format(**entities))
+
+def find_files(derivatives=False, root=None, **filters):
+    """Glob BIDS files by entity without indexing the dataset.
+
+    Accepts the same entity filters as ``BIDSLayout.get`` (``subject``,
+    ``task``, ``acquisition``, ``suffix``, ``extension``, ``datatype``...),
+    each a value or list of values. Searches the raw dataset and, with
+    ``derivatives``, also ``derivatives/``. Returns sorted BIDSPath objects.
+    """
+    root = ROOT_DIR if root is None else Path(root)
+    filters = {k: [v] if isinstance(v, str) else list(v) for k, v in filters.items() if v is not None}
+    subjects = filters.get("subject", ["*"])
+    roots = [root, root / "derivatives"] if derivatives else [root]
+    # Narrow the glob with what is known, the regex does the rest.
+    name = "sub-{}_*"
+    if len(filters.get("suffix", [])) == 1:
+        name += filters["suffix"][0]
+    if len(filters.get("extension", [])) == 1:
+        name += filters["extension"][0]
+    files = []
+    for base in roots:
+        for subject in subjects:
+            files += base.glob(f"sub-{subject}/{name.format(subject)}")
+            files += base.glob(f"sub-{subject}/*/{name.format(subject)}")
+    bids_files = []
+    for path in sorted(set(files)):
+        entities = parse_entities(path)
+        if entities is None:
+            continue
+        if all(entities.get(k) in values for k, values in filters.items()):
+            bids_files.append(BIDSPath(path, entities))
+    return bids_files
+
+
+
+################################################################################
+# TABULAR DATA
+################################################################################
+
+
+# Column dtypes of each tsv suffix. Columns not listed are inferred.
+TSV_SCHEMAS = {
+    "events": {
+        "onset": "float64",
+        "duration": "float64",
+        "value": "int64",
+        "description": "category",
+        "volume": "float64",
+    },
+    "hypno": {
+        "onset": "int64",
+        "duration": "int64",
+        "value": "uint8",
+        "description": pd.CategoricalDtype(SLEEP_STAGES),
+        "scorer": "category",
+        "eeg_channel": "category",
+        "eog_channel": "category",
+        "emg_channel": "category",
+        "epoch": "int64",
+        "proba_N1": "float32",
+        "proba_N2": "float32",
+        "proba_N3": "float32",
+        "proba_R": "float32",
+        "proba_W": "float32",
+    },
+    "resp": {
+        "channel": "category",
+        "time": "float64",
+    },
+    "cues": {
+        "stage": pd.CategoricalDtype(SLEEP_STAGES),
+        "frequency": "int64",
+        "n_cues": "int64",
+        "seconds": "float64",
+        "minutes": "float64",
+        "density": "float64",
+        "volume_mean": "float64",
+        "volume_min": "float64",
+        "volume_max": "float64",
+    },
+    "rrv": {
+        "channel": "category",
+        "cue": "int64",
+        "location": "category",
+    },
+    "beh": {
+        "cycle": "int64",
+        "press": "int64",
+        "response": "category",
+        "timestamp": "float64",
+        "accuracy": "category",
+    },
+    "rep": {
+        "awakening_id": "string",  # e.g., "awk-01"
+    },
+}
+TABLE_CACHE_DIR = DERIVATIVES_DIR / ".cache" / "tables"
+
+
+def read_tsv(filepath, suffix=None, cache=True, **kwargs):
+    """Read a BIDS tsv file with explicit dtypes for its suffix.
+
+    The parsed frame is pickled under ``TABLE_CACHE_DIR`` together with the
+    file's mtime/size (and the schema) and reused until either changes. Extra keyword
+    arguments go to ``pandas.read_csv`` (and bypass the cache).
+    """
+    filepath = Path(filepath)
+    if suffix is None:
+        entities = parse_entities(filepath)
+        suffix = None if entities is None else entities["suffix"]
+    cache = cache and not kwargs
+    if cache:
+        key = hashlib.sha1(filepath.resolve().as_posix().encode("utf-8")).hexdigest()
+        cache_path = TABLE_CACHE_DIR / f"{key}.pkl"
+        signature = (file_signature(filepath), repr(TSV_SCHEMAS.get(suffix)))
+        cached = import_pickle(cache_path)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+    kwargs = {"sep": "\t", "na_values": "n/a", "encoding": "utf-8", "dtype": TSV_SCHEMAS.get(suffix)} | kwargs
+    df = pd.read_csv(filepath, **kwargs)
+    if cache:
+        export_pickle((signature, df), cache_path)
+    return df
+
+
+
+# Column name of each entity in group tables (values keep their BIDS prefix, e.g. "sub-001").
+ENTITY_COLUMNS = {
+    "subject": "participant_id",
+    "session": "session_id",
+    "task": "task_id",
+    "acquisition": "acquisition_id",
+    "run": "run_id",
+}
+
+
+def load_group(entities=("subject",), columns=None, derivatives=False, max_workers=8, cache=True, **filters):
+    """Stack one tsv per matching file into a single group table.
+
+    Parameters
+    ----------
+    entities : list of str
+        Entities to add as columns (see ``ENTITY_COLUMNS``), as categoricals.
+    columns : list of str
+        Only keep these columns of each file. With ``cache`` the full cached
+        table is read and the columns are selected afterwards, without it
+        only these columns are parsed (``usecols``).
+    derivatives : bool
+        Also search ``derivatives/``.
+    max_workers : int
+        Files are read concurrently on a thread pool of this size.
+    cache : bool
+        Read the files through the table cache (see :func:`read_tsv`).
+    **filters
+        Entity filters passed to :func:`find_files` (``task``, ``acquisition``, ``suffix``...).
+
+    Returns
+    -------
+    df : pandas.DataFrame
+        Entity columns first, then the file columns, in file order.
+    """
+    filters = {"extension": ".tsv"} | filters
+    bids_files = find_files(derivatives=derivatives, **filters)
+
+    def load(bf):
+        if columns is not None and not cache:
+            df = bf.get_df(cache=False, usecols=columns)[columns]
+        else:
+            df = bf.get_df(cache=cache)
+            if columns is not None:
+                df = df[columns]
+        for entity in reversed(entities):
+            df.insert(0, ENTITY_COLUMNS[entity], f"{BIDS_ENTITIES[entity]}-{bf.entities[entity]}")
+        return df
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        dataframes = list(executor.map(load, bids_files))
+    if not dataframes:
+        return pd.DataFrame(columns=[ENTITY_COLUMNS[e] for e in entities] + (columns or []))
+    df = pd.concat(dataframes, ignore_index=True)
+    # Concatenating categoricals with different categories gives object columns.
+    categorical = [ENTITY_COLUMNS[e] for e in entities] + dataframes[0].select_dtypes("category").columns.tolist()
+    df[categorical] = df[categorical].astype("category")
+    return df
+
+
+
 ################################################################################
 # SMACC LOG PROCESSING
 ################################################################################
 
-def read_smacc_log(filepath):
+# One pass over each log message, e.g.
+#   "CueStarted-lux3_Cue1 - Volume 0.2 - Sent portcode 12"
+#   "Parallel port connection succeeded. - Sent portcode 1"
+SMACC_MSG_PATTERN = (
+    r"^(?P<description>[^-]*?)"
+    r"(?:-(?P<stim_file>[^-]*?)(?:-[^-]*?)*?)?"
+    r"(?: - Volume (?P<volume>.*?))?"
+    r"(?: - .*?)?"
+    r" - Sent portcode (?P<value>-?\d+)$"
+)
+SMACC_CACHE_DIR = DERIVATIVES_DIR / ".cache" / "smacc"
+SMACC_CACHE_VERSION = 1  # Bump when the parsed output changes.
+
+
+def file_signature(filepath):
+    """Cheap change-detection key for a file (modification time and size)."""
+    stat = Path(filepath).stat()
+    return f"{stat.st_mtime_ns}-{stat.st_size}"
+
+def read_smacc_log(filepath, cache=False):
+    """Parse a SMACC log file into one row per portcode event.
+
+    If ``cache`` is True, the parsed table is pickled under
+    ``SMACC_CACHE_DIR`` and reused as long as the log file's modification
+    time and size are unchanged.
+    """
+    filepath = Path(filepath)
+    if cache:
+        cache_path = SMACC_CACHE_DIR / f"{filepath.stem}_v{SMACC_CACHE_VERSION}_{file_signature(filepath)}.pkl"
+        df = import_pickle(cache_path)
+        if df is not None:
+            return df
     # early_subject = "sub-90" in filepath.name
     df = pd.read_csv(filepath, names=["timestamp", "msg_level", "msg"], parse_dates=["timestamp"])
     # Localize timestamp.
@@ -88,40 +479,216 @@ def read_smacc_log(filepath):
     df["msg"] = df["msg"].str.strip()
     # Drop msg_level column (useless because always "INFO")
     df = df.drop(columns="msg_level")
-    # Drop some rows that are useless.
-    df = df[df.msg.ne("Opened TWC interface v0.0")]
-    df = df[df.msg.ne("Program closed")]
-    df = df[~df.msg.str.contains("VolumeSet")]
     # Reduce to only events with portcodes
+    # (drops "Opened TWC interface", "Program closed", "VolumeSet", etc.)
     assert not df.msg.str.contains("Failed portcode").any()
-    df = df.loc[df.msg.str.contains("Sent portcode")]
-    # Expand single "msg" column to "description" and "value"
-    df["value"] = df.msg.str.split(" - ").str[-1].str.split().str[-1].astype(int)
-    df["description"] = df.msg.str.split(" - ").str[0].str.split("-").str[0]
-    df["stim_file"] = df.msg.str.split(" - ").str[0].str.split("-").str[1].add(".wav")
-    df["trial_type"] = np.nan
-    df.loc[df.stim_file.str.startswith("lux3").fillna(False), "trial_type"] = "bct"
-    df.loc[df.stim_file.str.startswith("med1").fillna(False), "trial_type"] = "mwt"
-    # df["trial_type"] = df.msg.str.split("CueStarted-").str[1].str.split("_").str[0].replace({"lux3": "bct", "med1": "mwt"})
+    parsed = df["msg"].str.extract(SMACC_MSG_PATTERN)
+    df = df.drop(columns="msg").join(parsed).dropna(subset=["value"])
+    df = df[~df.description.str.startswith("VolumeSet")]
+    # Typed columns.
+    df["value"] = df["value"].astype(int)
+    df["volume"] = pd.to_numeric(df["volume"])
+    df["stim_file"] = df["stim_file"].add(".wav")
+    df["trial_type"] = df["stim_file"].str[:4].map({"lux3": "bct", "med1": "mwt"})
     # Get duration of each cue (this ASSUMES there is a start for every stop)
-    assert df.msg.str.contains("CueStarted").sum() == df.msg.str.contains("CueStarted").sum(), "Make sure each cue has both start and stop messages."
-    assert df.msg.str.contains("DreamReportStarted").sum() == df.msg.str.contains("DreamReportStopped").sum(), "Make sure each dream report has both start and stop messages."
+    counts = df["description"].value_counts()
+    assert counts.get("CueStarted", 0) == counts.get("CueStopped", 0), "Make sure each cue has both start and stop messages."
+    assert counts.get("DreamReportStarted", 0) == counts.get("DreamReportStopped", 0), "Make sure each dream report has both start and stop messages."
     df["duration"] = df["timestamp"].diff().dt.total_seconds().shift(-1)
     df.loc[~df.description.isin(["CueStarted", "DreamReportStarted"]), "duration"] = np.nan
     # Now able to drop the Stopped codes.
-    df = df.loc[~df.msg.str.contains("Stopped")]
-    df["description"] = df.description.str.rsplit("Started").str[0]
-    # Add *initial* volume for cues.
-    df["volume"] = df.msg.str.split("Volume ").str[1].str.split(" - ").str[0]
+    df = df.loc[~df.description.str.endswith("Stopped")]
+    df["description"] = df.description.str.removesuffix("Started")
     df.loc[df.description.str.startswith("Parallel port connection"), "description"] = "CONNECTION"
-    # df["description"] = df["description"].replace({"Parallel port connection succeeded.": "CONNECTION"})
-    df = df.drop(columns="msg")
     # Remove cues from before lights were out??
 
     # Check some expectations.
     assert df.description.value_counts().at["CONNECTION"] == 1
 
-    return df.reset_index(drop=True).sort_values("timestamp")
+    df = df[["timestamp", "value", "description", "stim_file", "trial_type", "duration", "volume"]]
+    df = df.reset_index(drop=True).sort_values("timestamp")
+    if cache:
+        export_pickle(df, cache_path)
+    return df
+
+def _robust_linear_fit(x, y, n_iter=20, k=1.345):
+    """Huber-weighted (IRLS) fit of ``y = intercept + slope * x``."""
+    X = np.column_stack([np.ones_like(x), x])
+    weights = np.ones_like(x)
+    for _ in range(n_iter):
+        sqrt_w = np.sqrt(weights)
+        coef = np.linalg.lstsq(X * sqrt_w[:, np.newaxis], y * sqrt_w, rcond=None)[0]
+        residuals = y - X @ coef
+        scale = np.median(np.abs(residuals - np.median(residuals))) / 0.6745
+        if scale == 0:
+            break
+        u = np.abs(residuals) / (k * scale)
+        new_weights = np.where(u <= 1, 1, 1 / np.maximum(u, 1e-12))
+        if np.allclose(new_weights, weights):
+            break
+        weights = new_weights
+    return coef, residuals
+
+def align_smacc_to_eeg(smacc, events, tolerance=0.5, n_passes=3):
+    """Map SMACC log timestamps onto the EEG clock and match them to EEG events.
+
+    Starts from the CONNECTION offset, then alternates between matching
+    every SMACC row to the nearest EEG event with the same portcode value
+    (sorted as-of merge, so O(n log n)) and refitting a robust linear model
+    (offset + drift) to the matched pairs.
+
+    Parameters
+    ----------
+    smacc : pandas.DataFrame
+        Output of :func:`read_smacc_log`.
+    events : pandas.DataFrame
+        EEG events with UTC ``timestamp`` and integer ``value`` columns.
+    tolerance : float
+        Maximum distance (in seconds) between a mapped SMACC timestamp and
+        its matched EEG event.
+    n_passes : int
+        Number of match/refit passes.
+
+    Returns
+    -------
+    smacc : pandas.DataFrame
+        Copy with ``timestamp`` mapped through the fit and an ``event_index``
+        column holding the matched ``events`` index label (NaN if unmatched).
+    report : dict
+        Fit and residual summary (in milliseconds). ``offset_s`` is the
+        SMACC clock minus the EEG clock at the EEG CONNECTION event and
+        ``drift_ppm`` how much faster the SMACC clock runs (positive when
+        it gains time on the EEG clock).
+    """
+    smacc = smacc.copy()
+    t0 = events.loc[events["description"].eq("CONNECTION"), "timestamp"].iloc[0]
+    t1 = smacc.loc[smacc["description"].eq("CONNECTION"), "timestamp"].iloc[0]
+    eeg = events.dropna(subset="timestamp")
+    eeg = pd.DataFrame({
+        "time": (eeg["timestamp"] - t0).dt.total_seconds(),
+        "value": eeg["value"].astype(int),
+        "event_index": eeg.index,
+    }).sort_values("time")
+    smacc_time = (smacc["timestamp"] - t1).dt.total_seconds().to_numpy()
+
+    def match(coef):
+        mapped = pd.DataFrame({
+            "time": coef[0] + coef[1] * smacc_time,
+            "value": smacc["value"].astype(int).to_numpy(),
+            "smacc_index": np.arange(len(smacc)),
+            "smacc_time": smacc_time,
+        }).sort_values("time")
+        matched = pd.merge_asof(
+            mapped, eeg.rename(columns={"time": "eeg_time"}),
+            left_on="time", right_on="eeg_time", by="value",
+            direction="nearest", tolerance=tolerance,
+        )
+        return matched.sort_values("smacc_index")
+
+    # Coarse alignment from CONNECTION alone, then offset + drift.
+    coef = np.array([0.0, 1.0])
+    for _ in range(n_passes):
+        matched = match(coef).dropna(subset="eeg_time")
+        if len(matched) < 2:
+            break
+        coef, residuals = _robust_linear_fit(matched["smacc_time"].to_numpy(), matched["eeg_time"].to_numpy())
+    matched = match(coef)
+    residuals_ms = matched["eeg_time"].sub(matched["time"]).dropna().abs().mul(1000)
+
+    smacc["timestamp"] = t0 + pd.to_timedelta(coef[0] + coef[1] * smacc_time, unit="s")
+    smacc["event_index"] = matched["event_index"].to_numpy()
+    report = {
+        "offset_s": float((t1 - t0).total_seconds() - coef[0]),
+        "drift_ppm": float((1 / coef[1] - 1) * 1e6),
+        "n_smacc": len(smacc),
+        "n_matched": int(matched["event_index"].notna().sum()),
+        "residual_median_ms": float(residuals_ms.median()),
+        "residual_max_ms": float(residuals_ms.max()),
+    }
+    return smacc, report
+
+
+
+################################################################################
+# PARTICIPANT CORRECTIONS
+################################################################################
+
+
+# Per-participant fixes to the SMACC log and EEG events live in CORRECTIONS_FILE,
+# keyed by participant ID and then by stage:
+#   "smacc"      -> SMACC log table, before alignment
+#   "eeg_events" -> EEG events table, before merging with SMACC
+#   "events"     -> merged events table, before splitting into tasks
+# Operations are applied in order, each one a single masked pass over the table:
+#   {"op": "drop", "slice": [start, stop], "descriptions": [...]}
+#       Drop rows by position, optionally counting only rows with these descriptions.
+#   {"op": "insert", "description": d, "anchor": {"description": a, "occurrence": i} or "end", "offset": s}
+#       Add event d at ``offset`` seconds from the i-th a event (or the end of the recording).
+#   {"op": "replace", "column": c, "mapping": {old: new}}
+# "note" entries are free-text documentation and are ignored.
+
+
+def load_corrections(participant_id):
+    """Return {stage: [operations]} for one participant (empty if none)."""
+    return import_json(CORRECTIONS_FILE).get(participant_id, {})
+
+def corrections_digest(participant_id):
+    """Hash of a participant's corrections, to detect when they change."""
+    corrections = json.dumps(load_corrections(participant_id), sort_keys=True)
+    return hashlib.sha256(corrections.encode("utf-8")).hexdigest()
+
+def apply_corrections(df, operations, codes=None, end=None):
+    """Apply a list of correction operations to an events-like table.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        Table with at least a ``description`` column (and ``onset`` for inserts).
+    operations : list of dict
+        Operations for one stage, see ``CORRECTIONS_FILE``.
+    codes : dict
+        {description: value} portcodes, used to fill ``value`` of inserted rows.
+    end : float
+        Recording end (seconds), for inserts anchored at "end".
+
+    Returns
+    -------
+    df : pandas.DataFrame
+        Corrected copy, with a fresh RangeIndex.
+    """
+    df = df.reset_index(drop=True)
+    for operation in operations:
+        op = operation["op"]
+        if op == "drop":
+            candidates = np.arange(len(df))
+            if "descriptions" in operation:
+                candidates = np.flatnonzero(df["description"].isin(operation["descriptions"]))
+            start, stop = operation["slice"]
+            drop_mask = np.zeros(len(df), dtype=bool)
+            drop_mask[candidates[slice(start, stop)]] = True
+            df = df.loc[~drop_mask].reset_index(drop=True)
+        elif op == "insert":
+            anchor = operation["anchor"]
+            if anchor == "end":
+                assert end is not None, "Need recording end to insert relative to it"
+                onset = np.floor(end)
+            else:
+                anchor_rows = df.loc[df["description"].eq(anchor["description"]), "onset"]
+                onset = anchor_rows.iloc[anchor["occurrence"]]
+            row = {
+                "onset": [onset + operation["offset"]],
+                "duration": [0],
+                "value": [codes[operation["description"]]],
+                "description": [operation["description"]],
+            }
+            df = pd.concat([df, pd.DataFrame(row)], ignore_index=True)
+            if operation.get("sort", True):
+                df = df.sort_values("onset").reset_index(drop=True)
+        elif op == "replace":
+            df[operation["column"]] = df[operation["column"]].replace(operation["mapping"])
+        else:
+            raise ValueError(f"Unknown correction operation '{op}'")
+    return df
 
 
 